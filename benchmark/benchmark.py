@@ -0,0 +1,530 @@
+#! /usr/bin/env python
+# encoding: utf-8
+
+"""Benchmarks for pytest-testdirectory.
+
+Each benchmark is a function taking a work directory as a pathlib.Path.
+It prepares its input and returns a function which is timed. The timed
+function is called with the index of the repetition.
+
+Usage::
+
+    python benchmark/benchmark.py [--repeat N] [--json FILE]
+        [--compare FILE] [--threshold RATIO] [PATTERN ...]
+
+Only the benchmarks matching one of the fnmatch patterns are run. The
+results can be written as JSON and compared with the JSON written by an
+earlier run, in which case the exit code is non-zero if a benchmark got
+slower by more than the threshold.
+"""
+
+import argparse
+import fnmatch
+import json
+import pathlib
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from pytest_testdirectory.checkoutput import CheckOutput
+from pytest_testdirectory.hashcache import HashCache
+from pytest_testdirectory.pythonpool import PythonPool
+from pytest_testdirectory.testdirectory import TestDirectory
+from pytest_testdirectory.trash import Trash
+
+BENCHMARKS = {}
+
+
+def benchmark(function):
+    """Register a benchmark function."""
+    BENCHMARKS[function.__name__] = function
+    return function
+
+
+def make_tree(path, width, depth, size):
+    """Create a directory tree with width files and width directories
+    on each level below path."""
+    path.mkdir(parents=True, exist_ok=True)
+
+    for index in range(width):
+        (path / f"file{index}.bin").write_bytes(b"x" * size)
+
+    if depth > 1:
+        for index in range(width):
+            make_tree(path / f"dir{index}", width=width, depth=depth - 1, size=size)
+
+
+def _copy_dir(workdir, width, depth, workers):
+    source = workdir / "source"
+    make_tree(source, width=width, depth=depth, size=4096)
+    testdirectory = TestDirectory(tmpdir=workdir)
+
+    def step(index):
+        if workers == "shutil":
+            shutil.copytree(source, workdir / f"copy{index}")
+        else:
+            testdirectory.mkdir(f"copy{index}").copy_dir(source, workers=workers)
+
+    return step
+
+
+@benchmark
+def copy_dir_wide_shutil(workdir):
+    return _copy_dir(workdir, width=2000, depth=1, workers="shutil")
+
+
+@benchmark
+def copy_dir_wide_serial(workdir):
+    return _copy_dir(workdir, width=2000, depth=1, workers=1)
+
+
+@benchmark
+def copy_dir_wide_parallel(workdir):
+    return _copy_dir(workdir, width=2000, depth=1, workers=None)
+
+
+@benchmark
+def copy_dir_deep_shutil(workdir):
+    return _copy_dir(workdir, width=6, depth=5, workers="shutil")
+
+
+@benchmark
+def copy_dir_deep_parallel(workdir):
+    return _copy_dir(workdir, width=6, depth=5, workers=None)
+
+
+@benchmark
+def copy_files_wide(workdir):
+    source = workdir / "source"
+    make_tree(source, width=2000, depth=1, size=4096)
+    testdirectory = TestDirectory(tmpdir=workdir)
+
+    def step(index):
+        testdirectory.mkdir(f"copy{index}").copy_files(str(source / "*"))
+
+    return step
+
+
+def _spec(width, files, size):
+    return {
+        f"dir{i}": {f"file{j}.txt": "x" * size for j in range(files)}
+        for i in range(width)
+    }
+
+
+@benchmark
+def populate_wide(workdir):
+    testdirectory = TestDirectory(tmpdir=workdir)
+    spec = _spec(width=40, files=50, size=100)
+
+    def step(index):
+        testdirectory.mkdir(f"tree{index}").populate(spec)
+
+    return step
+
+
+@benchmark
+def populate_wide_write_text(workdir):
+    testdirectory = TestDirectory(tmpdir=workdir)
+    spec = _spec(width=40, files=50, size=100)
+
+    def step(index):
+        tree = testdirectory.mkdir(f"tree{index}")
+
+        for directory, files in spec.items():
+            subdirectory = tree.mkdir(directory)
+
+            for filename, content in files.items():
+                subdirectory.write_text(filename, content)
+
+    return step
+
+
+def _python(code):
+    """:return: A shell command running the Python code"""
+    return '"{}" -c "{}"'.format(sys.executable, code)
+
+
+@benchmark
+def run_small_output(workdir):
+    testdirectory = TestDirectory(tmpdir=workdir)
+    command = _python("print('hello')")
+
+    def step(index):
+        testdirectory.run(command)
+
+    return step
+
+
+@benchmark
+def run_python_module(workdir):
+    testdirectory = TestDirectory(tmpdir=workdir)
+    testdirectory._shared.pythonpool = PythonPool()
+    testdirectory.write_text("data.json", '{"hello": [1, 2, 3]}')
+
+    def step(index):
+        testdirectory.run_python("json.tool", ["data.json"])
+
+    return step
+
+
+@benchmark
+def run_python_module_subprocess(workdir):
+    testdirectory = TestDirectory(tmpdir=workdir)
+    testdirectory.write_text("data.json", '{"hello": [1, 2, 3]}')
+
+    def step(index):
+        testdirectory.run_python("json.tool", ["data.json"])
+
+    return step
+
+
+@benchmark
+def run_small_output_shell(workdir):
+    testdirectory = TestDirectory(tmpdir=workdir)
+    command = [sys.executable, "-c", "print('hello')"]
+
+    def step(index):
+        testdirectory.run(command, shell=True)
+
+    return step
+
+
+@benchmark
+def run_small_output_direct(workdir):
+    testdirectory = TestDirectory(tmpdir=workdir)
+    command = [sys.executable, "-c", "print('hello')"]
+
+    def step(index):
+        testdirectory.run(command)
+
+    return step
+
+
+def _run_huge_output(workdir, capture, **kwargs):
+    testdirectory = TestDirectory(tmpdir=workdir)
+    command = _python(
+        "import sys; sys.stdout.writelines('%d\\n' % i for i in range(2000000))"
+    )
+
+    def step(index):
+        testdirectory.run(command, capture=capture, **kwargs)
+
+    return step
+
+
+@benchmark
+def run_huge_output_memory(workdir):
+    return _run_huge_output(workdir, capture="memory")
+
+
+@benchmark
+def run_huge_output_file(workdir):
+    return _run_huge_output(workdir, capture="file")
+
+
+@benchmark
+def run_huge_output_bytes(workdir):
+    return _run_huge_output(workdir, capture="bytes")
+
+
+@benchmark
+def run_huge_output_tail(workdir):
+    return _run_huge_output(workdir, capture="memory", tail=100)
+
+
+@benchmark
+def run_huge_output_discard(workdir):
+    return _run_huge_output(workdir, capture="discard")
+
+
+def _rmdir(workdir, trash):
+    testdirectory = TestDirectory(tmpdir=workdir)
+    testdirectory._shared.trash = trash
+
+    # The trees are created up front for the first 10 repetitions, the
+    # later ones create their tree while timed
+    trees = 10
+
+    for index in range(trees):
+        make_tree(workdir / f"tree{index}", width=8, depth=3, size=1000)
+
+    def step(index):
+        if index >= trees:
+            make_tree(workdir / f"tree{index}", width=8, depth=3, size=1000)
+
+        testdirectory.join(f"tree{index}").rmdir()
+
+    return step
+
+
+@benchmark
+def rmdir_rmtree(workdir):
+    return _rmdir(workdir, trash=None)
+
+
+@benchmark
+def rmdir_trash(workdir):
+    return _rmdir(workdir, trash=Trash(path=workdir / "trash"))
+
+
+def _assert_matches_tree(workdir, hashcache):
+    make_tree(workdir / "reference", width=8, depth=3, size=100000)
+    shutil.copytree(workdir / "reference", workdir / "actual")
+
+    testdirectory = TestDirectory(tmpdir=workdir / "actual")
+    testdirectory._shared.hashcache = hashcache
+
+    def step(index):
+        testdirectory.assert_matches_tree(workdir / "reference")
+
+    return step
+
+
+@benchmark
+def assert_matches_tree(workdir):
+    return _assert_matches_tree(workdir, hashcache=None)
+
+
+@benchmark
+def assert_matches_tree_hashcache(workdir):
+    return _assert_matches_tree(workdir, hashcache=HashCache())
+
+
+def _contains_file(workdir, index):
+    make_tree(workdir / "tree", width=50, depth=2, size=0)
+    testdirectory = TestDirectory(tmpdir=workdir / "tree")
+
+    if index:
+        testdirectory.enable_index()
+
+    def step(_):
+        for lookup in range(500):
+            testdirectory.contains_file(f"dir{lookup % 50}/file{lookup % 50}.b*")
+
+    return step
+
+
+@benchmark
+def contains_file_glob(workdir):
+    return _contains_file(workdir, index=False)
+
+
+@benchmark
+def contains_file_glob_indexed(workdir):
+    return _contains_file(workdir, index=True)
+
+
+def _output(lines):
+    return CheckOutput(output="\n".join(f"line {i} of output" for i in range(lines)))
+
+
+@benchmark
+def checkoutput_match_1m(workdir):
+    output = _output(lines=1000000)
+
+    def step(index):
+        output.match("*999999*")
+
+    return step
+
+
+@benchmark
+def checkoutput_find_1m(workdir):
+    output = _output(lines=1000000)
+
+    def step(index):
+        output.find("line *5 of *")
+
+    return step
+
+
+@benchmark
+def checkoutput_match_compressed_100k(workdir):
+    output = CheckOutput(
+        output="\n".join(f"line {i} of output" for i in range(100000)), compress=True
+    )
+
+    def step(index):
+        output.match("*99999*")
+
+    return step
+
+
+@benchmark
+def checkoutput_match_in_order_10_patterns_1m(workdir):
+    output = _output(lines=1000000)
+    patterns = [f"line {i}99999 *" for i in range(10)]
+
+    def step(index):
+        output.match_in_order(patterns)
+
+    return step
+
+
+@benchmark
+def checkoutput_match_10_patterns_1m(workdir):
+    output = _output(lines=1000000)
+    patterns = [f"line {i}99999 *" for i in range(10)]
+
+    def step(index):
+        for pattern in patterns:
+            output.match(pattern)
+
+    return step
+
+
+@benchmark
+def checkoutput_match_all_10_patterns_1m(workdir):
+    output = _output(lines=1000000)
+    patterns = [f"line {i}99999 *" for i in range(10)]
+
+    def step(index):
+        output.match_all(patterns)
+
+    return step
+
+
+def _fixture(workdir, fixture):
+    """Run a pytest session with 100 tests requesting the fixture"""
+    tests = workdir / "test_fixture.py"
+    tests.write_text(
+        "import pytest\n\n"
+        "@pytest.mark.parametrize('index', range(100))\n"
+        f"def test_fixture({fixture}, index):\n"
+        "    pass\n"
+    )
+
+    command = [sys.executable, "-m", "pytest", "-q", "-p", "no:cacheprovider"]
+
+    if not _plugin_installed():
+        command += ["-p", "pytest_testdirectory.testdirectory"]
+
+    def step(index):
+        subprocess.run(
+            command + ["--basetemp", str(workdir / f"basetemp{index}"), str(tests)],
+            stdout=subprocess.DEVNULL,
+            check=True,
+        )
+
+    return step
+
+
+def _plugin_installed():
+    """:return: True if pytest loads the plugin through its entry point"""
+    from importlib import metadata
+
+    entry_points = metadata.entry_points()
+
+    if hasattr(entry_points, "select"):
+        entry_points = entry_points.select(group="pytest11")
+    else:
+        entry_points = entry_points.get("pytest11", [])
+
+    return any(entry.name == "testdirectory" for entry in entry_points)
+
+
+@benchmark
+def fixture_tmp_path_100_tests(workdir):
+    return _fixture(workdir, fixture="tmp_path")
+
+
+@benchmark
+def fixture_testdirectory_100_tests(workdir):
+    return _fixture(workdir, fixture="testdirectory")
+
+
+def run(name, repeat):
+    with tempfile.TemporaryDirectory(prefix=f"benchmark-{name}-") as workdir:
+        step = BENCHMARKS[name](pathlib.Path(workdir))
+        times = []
+
+        for index in range(repeat):
+            start = time.perf_counter()
+            step(index)
+            times.append(time.perf_counter() - start)
+
+    return {
+        "name": name,
+        "times": times,
+        "min": min(times),
+        "median": statistics.median(times),
+        "mean": statistics.mean(times),
+    }
+
+
+def compare(results, baseline, threshold):
+    """Compare the results with the results of an earlier run.
+
+    :return: The names of the benchmarks which got slower by more than the
+        threshold
+    """
+    baseline = {result["name"]: result for result in baseline["benchmarks"]}
+    regressions = []
+
+    for result in results:
+        if result["name"] not in baseline:
+            continue
+
+        ratio = result["median"] / baseline[result["name"]]["median"]
+        print("{:<40} {:6.2f}x of baseline".format(result["name"], ratio))
+
+        if ratio > threshold:
+            regressions.append(result["name"])
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("patterns", nargs="*", default=["*"])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument("--compare", help="Compare with the results in this file")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=1.2,
+        help="Slowdown ratio of the median accepted by --compare",
+    )
+    options = parser.parse_args()
+
+    results = []
+
+    for name in BENCHMARKS:
+        if not any(fnmatch.fnmatch(name, p) for p in options.patterns):
+            continue
+
+        result = run(name=name, repeat=options.repeat)
+        results.append(result)
+
+        print(
+            "{:<40} min {:10.6f}s  median {:10.6f}s".format(
+                name, result["min"], result["median"]
+            )
+        )
+
+    if options.json:
+        report = {
+            "python": sys.version,
+            "platform": platform.platform(),
+            "repeat": options.repeat,
+            "benchmarks": results,
+        }
+        pathlib.Path(options.json).write_text(json.dumps(report, indent=4))
+
+    if options.compare:
+        baseline = json.loads(pathlib.Path(options.compare).read_text())
+        regressions = compare(results, baseline, threshold=options.threshold)
+
+        if regressions:
+            print("Regressions: {}".format(", ".join(regressions)))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,79 @@
+import array
+import bisect
 import fnmatch
+import itertools
+import operator
+import os
+import posixpath
+import re
+import zlib
 
 
 class CheckOutput:
     """Stores the output after running a command typically standard
     output or standard error.
 
+    The output is kept as a single string with an index of where each line
+    starts and ends, rather than as a string per line, which costs 16 bytes
+    per line instead of a string object. The index is built the first time
+    the lines are needed. Where possible the output is searched for the
+    literal part of a pattern first, and only the lines containing it are
+    matched. The lines can be counted, indexed and sliced like a list::
+
+        assert len(out) == 3
+        assert out[0] == "first line"
+        assert out[-2:].match("*done*")
+
+    The output can also be stored compressed with zlib, e.g. when many
+    results are kept, in which case it is decompressed each time it is
+    accessed.
+
     Attributes:
 
-    :output: List of strings representing the output (split by newlines)
+    :output: List of strings representing the output (split by newlines),
+        created when accessed
 
     """
 
-    def __init__(self, output):
+    __slots__ = ("_text", "_compressed", "_starts", "_ends")
+
+    # The number of lines containing the literal part of a pattern after
+    # which the output is matched line by line, if most lines contain it
+    dense_lines = 1000
+
+    def __init__(self, output, compress=False):
         """Creates a new CheckOutput object
 
         :param output: String representing the output
+        :param compress: If True the output is stored compressed
         """
-        self.output = output.splitlines()
+        self._starts = None
+        self._ends = None
+
+        if compress:
+            self._text = None
+            self._compressed = zlib.compress(output.encode("utf-8", "surrogatepass"))
+        else:
+            self._text = output
+            self._compressed = None
+
+    @property
+    def output(self):
+        """List of strings representing the output (split by newlines),
+        created when accessed."""
+        if self._starts is None:
+            return self._index()[0].splitlines()
+
+        return list(self)
+
+    @property
+    def compressed(self):
+        """True if the output is stored compressed"""
+        return self._compressed is not None
+
+    @output.setter
+    def output(self, lines):
+        CheckOutput.__init__(self, _join(lines), compress=self.compressed)
 
     def match(self, pattern):
         """Matches the lines in the output with the pattern. The match
@@ -50,8 +107,202 @@ class CheckOutput:
                  lines.
 
         """
-        match_lines = fnmatch.filter(self.output, pattern)
-        return len(match_lines) > 0
+        return self.match_any([pattern])
+
+    def match_any(self, patterns):
+        """Matches the lines in the output with a number of patterns. The
+        patterns are compiled into a single regular expression and the search
+        stops at the first line matching one of them.
+
+        See match(...) for the supported wildcards.
+
+        Simple example:
+
+            out.match_any(['*success*', '*skipped*'])
+
+        :param patterns: List of patterns to search for in the output
+
+        :return: True if one or more of the patterns are found in the output
+                 lines.
+        """
+        if self._searchable(patterns):
+            # A search of the output per pattern beats a single pass line
+            # by line, unless the literal part of a pattern is in most lines
+            dense = []
+
+            for pattern in patterns:
+                number = next(self._matching(pattern, sparse=True), None)
+
+                if number is _DENSE:
+                    dense.append(pattern)
+                elif number is not None:
+                    return True
+
+            if not dense:
+                return False
+
+            patterns = dense
+
+        regex = self._compile(patterns)
+        return any(regex.match(line) for line in self._lines())
+
+    def match_all(self, patterns):
+        """Matches the lines in the output with a number of patterns. All
+        patterns are matched in a single pass over the output which stops as
+        soon as every pattern has been found.
+
+        See match(...) for the supported wildcards.
+
+        Simple example:
+
+            out.match_all(['*started*', '*finished*'])
+
+        :param patterns: List of patterns to search for in the output
+
+        :return: True if every pattern is found in one or more of the output
+                 lines.
+        """
+        remaining = list(dict.fromkeys(_normcase(pattern) for pattern in patterns))
+
+        if self._searchable(remaining):
+            # Only the patterns whose literal part is in most lines are
+            # matched in the single pass
+            dense = []
+
+            for pattern in remaining:
+                number = next(self._matching(pattern, sparse=True), None)
+
+                if number is None:
+                    return False
+
+                if number is _DENSE:
+                    dense.append(pattern)
+
+            remaining = dense
+
+            if not remaining:
+                return True
+
+        regex = _compile(remaining)
+
+        for line in self._lines():
+            if not regex.match(line):
+                continue
+
+            # The line may match several of the remaining patterns
+            remaining = [p for p in remaining if not fnmatch.fnmatchcase(line, p)]
+
+            if not remaining:
+                return True
+
+            regex = _compile(remaining)
+
+        return not remaining
+
+    def find(self, pattern):
+        """Find the lines in the output matching a pattern.
+
+        See match(...) for the supported wildcards.
+
+        Simple example:
+
+            assert out.find('*error*') == [3, 17]
+
+        :param pattern: Pattern to search for in the output
+
+        :return: List of the numbers of the matching lines, counting from 0
+        """
+        return list(self._matching(pattern))
+
+    def count(self, pattern):
+        """Count the lines in the output matching a pattern.
+
+        See match(...) for the supported wildcards.
+
+        :param pattern: Pattern to search for in the output
+
+        :return: The number of matching lines
+        """
+        return sum(1 for _ in self._matching(pattern))
+
+    def match_in_order(self, patterns):
+        """Matches the lines in the output with a sequence of patterns, which
+        must match different lines in the given order. Other lines may come
+        before, between and after them. The patterns are matched in a single
+        pass over the output which stops when the last pattern is found.
+
+        See match(...) for the supported wildcards.
+
+        Simple example:
+
+            out.match_in_order(['*connecting*', '*connected*', '*closed*'])
+
+        :param patterns: List of patterns to search for in the output
+
+        :return: True if the patterns match lines in the order given
+        """
+        if not patterns:
+            return True
+
+        # Matching each pattern at the first line possible leaves the most
+        # lines for the following patterns
+        if self._searchable(patterns):
+            start = 0
+
+            for pattern in patterns:
+                number = next(self._matching(pattern, start=start), None)
+
+                if number is None:
+                    return False
+
+                start = number + 1
+
+            return True
+
+        regexes = [self._compile([pattern]) for pattern in patterns]
+        position = 0
+
+        for line in self._lines():
+            if regexes[position].match(line):
+                position += 1
+
+                if position == len(regexes):
+                    return True
+
+        return False
+
+    def __len__(self):
+        """:return: The number of lines in the output"""
+        return len(self._indexed()._index()[1])
+
+    def __getitem__(self, key):
+        """Get a line, or a slice of the lines, of the output.
+
+        :param key: The number of the line or a slice
+        :return: The line as a string, or a CheckOutput with the lines of
+            the slice sharing the output of this one
+        """
+        text, starts, ends = self._indexed()._index()
+
+        if isinstance(key, slice) and key.step not in (None, 1):
+            # The lines are not adjacent in the output
+            lines = (text[start:end] for start, end in zip(starts, ends))
+            return CheckOutput(_join(list(lines)[key]))
+
+        if isinstance(key, slice):
+            lines = CheckOutput(text)
+            lines._starts = starts[key]
+            lines._ends = ends[key]
+            return lines
+
+        return text[starts[key] : ends[key]]
+
+    def __iter__(self):
+        """Iterate over the lines in the output."""
+        text, starts, ends = self._index()
+
+        for start, end in zip(starts, ends):
+            yield text[start:end]
 
     def __str__(self):
         """
@@ -59,7 +310,7 @@ class CheckOutput:
 
         :return: A string representing the output.
         """
-        return "\n".join(self.output)
+        return "\n".join(self)
 
     def __repr__(self):
         """
@@ -67,4 +318,183 @@ class CheckOutput:
 
         :return: A string representing the output.
         """
-        return 'CheckOutput: "{}"'.format("\n".join(self.output))
+        return 'CheckOutput: "{}"'.format(self)
+
+    def _index(self):
+        """Build the index of the lines if it is not built yet. The index of
+        compressed output is built each time, as it would take more memory
+        than the compressed output itself.
+
+        :return: Tuple with the output, an array of the offsets where each
+            line starts and an array of the offsets where each line ends in
+            the output, without the line ending
+        """
+        if self._compressed is not None:
+            text = zlib.decompress(self._compressed).decode("utf-8", "surrogatepass")
+            return (text,) + _build_index(text)
+
+        if self._starts is None:
+            self._starts, self._ends = _build_index(self._text)
+
+        return self._text, self._starts, self._ends
+
+    def _matching(self, pattern, start=0, sparse=False):
+        """Iterate over the numbers of the lines matching a pattern, from the
+        line start.
+
+        If the pattern contains a literal part, see _searchable(...), the
+        output is searched for it with str.find(...), which is much faster
+        than matching the lines, and only the lines containing it are
+        matched. Otherwise the lines are matched one at a time.
+
+        If sparse is True and the literal is found in most lines, _DENSE is
+        yielded instead of matching the rest of the lines one at a time, so
+        the caller can match several patterns in a single pass.
+        """
+        regex = self._compile([pattern])
+
+        if not self._searchable([pattern]):
+            for number, line in enumerate(self._lines()):
+                if number >= start and regex.match(line):
+                    yield number
+
+            return
+
+        literal = _literal(pattern)
+        text, starts, ends = self._index()
+        number = start
+
+        # The number of lines containing the literal
+        found = 0
+
+        while number < len(starts):
+            if found > self.dense_lines and found * 2 > number - start:
+                if sparse:
+                    yield _DENSE
+                    return
+
+                # The literal is in most lines, so matching every line is
+                # faster than searching for it
+                for number in range(number, len(starts)):
+                    if regex.match(text, starts[number], ends[number]):
+                        yield number
+
+                return
+
+            position = text.find(literal, starts[number], ends[-1])
+
+            if position < 0:
+                return
+
+            if position >= ends[number]:
+                # The literal contains no line endings, so it is inside a
+                # later line
+                number = bisect.bisect_right(starts, position, lo=number) - 1
+
+            if regex.match(text, starts[number], ends[number]):
+                yield number
+
+            found += 1
+            number += 1
+
+    def _searchable(self, patterns):
+        """:return: True if the output can be searched for a literal part of
+        each of the patterns, see _matching(...)"""
+        if os.path is not posixpath:
+            # The lines are normalized, see _lines(...)
+            return False
+
+        return all(_literal(pattern) for pattern in patterns)
+
+    def _indexed(self):
+        """:return: A CheckOutput with the output in memory and its index,
+        for the subclasses which store the output differently"""
+        return self
+
+    @staticmethod
+    def _compile(patterns):
+        """Compile a list of patterns into a single regular expression
+        matching the lines returned by _lines(...)."""
+        return _compile(patterns)
+
+    def _lines(self):
+        """Iterate over the lines in the output normalized the same way as
+        fnmatch.filter(...) does it."""
+        if os.path is posixpath:
+            return iter(self)
+        return map(os.path.normcase, self)
+
+
+def _normcase(pattern):
+    """Normalize the case of a pattern, see _lines(...)."""
+    if os.path is posixpath:
+        return pattern
+    return os.path.normcase(pattern)
+
+
+# The number of characters of output split into lines at a time
+_INDEX_BLOCK_SIZE = 1024 * 1024
+
+
+def _build_index(text):
+    """Index the lines of a string, see CheckOutput._index(...).
+
+    The lines are split by str.splitlines(...), which implements the line
+    endings in C, and only the lengths of the lines are kept. The output
+    is split a block at a time, so only the lines of one block exist at
+    the same time.
+    """
+    starts = array.array("q")
+    ends = array.array("q")
+    position = 0
+
+    while position < len(text):
+        # A block ends after a \n, which always ends a line
+        end = text.find("\n", position + _INDEX_BLOCK_SIZE)
+        end = len(text) if end < 0 else end + 1
+        block = text[position:end]
+
+        lengths = map(len, block.splitlines(keepends=True))
+        block_starts = array.array(
+            "q", itertools.accumulate(itertools.chain([position], lengths))
+        )
+        block_starts.pop()
+
+        starts.extend(block_starts)
+        ends.extend(map(operator.add, block_starts, map(len, block.splitlines())))
+
+        position = end
+
+    return starts, ends
+
+
+def _join(lines):
+    """Join lines into a string which str.splitlines(...) splits into the
+    same lines, including empty lines at the end."""
+    return "".join(line + "\n" for line in lines)
+
+
+# Yielded by CheckOutput._matching(...) when searching is not worth it
+_DENSE = object()
+
+# The line endings of str.splitlines(...)
+_LINE_BREAKS = re.compile("[\n\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029]")
+
+
+def _literal(pattern):
+    """:return: The longest part of a pattern which a matching line must
+    contain literally, or "" if there is none. The part of the pattern after
+    a [seq] is not considered, as the end of the seq is ambiguous."""
+    pattern = pattern.split("[", 1)[0]
+    parts = re.split(r"[*?]", pattern)
+    parts = [part for p in parts for part in _LINE_BREAKS.split(p)]
+    return max(parts, key=len)
+
+
+def _compile(patterns):
+    """Compile a list of patterns into a single regular expression matching
+    a line if any of the patterns match it."""
+    regex = "|".join(fnmatch.translate(_normcase(pattern)) for pattern in patterns)
+
+    # An empty list of patterns should never match
+    return re.compile(regex or "(?!)")
@@ -0,0 +1,178 @@
+import fnmatch
+import locale
+import re
+
+from . import checkoutput
+
+# Finds the end of each line in the output
+_NEWLINE = re.compile(b"\n")
+
+
+class CheckOutputBytes(checkoutput.CheckOutput):
+    """Stores the output of a command as bytes, without decoding it.
+
+    The lines are matched directly in the buffer, one line at a time, so
+    binary output and output in an unknown encoding can be checked without
+    copying or decoding it. The output is only decoded to build the string
+    representation.
+
+    Patterns given as bytes are matched byte by byte. Patterns given as
+    strings are encoded with the preferred encoding of the locale first,
+    so ? matches a single byte and not a single character. Matching is
+    always case sensitive.
+
+    Attributes:
+
+    :data: The output as bytes or a memoryview
+    """
+
+    __slots__ = ("data",)
+
+    def __init__(self, output):
+        """Creates a new CheckOutputBytes object
+
+        :param output: The output as bytes or a bytes-like object e.g. a
+            memoryview
+        """
+        self.data = output
+
+    @property
+    def output(self):
+        """List of strings representing the output (split by newlines),
+        decoded when accessed."""
+        return str(self).split("\n") if len(self.data) else []
+
+    @property
+    def compressed(self):
+        """False, the output is never stored compressed"""
+        return False
+
+    def match_any(self, patterns):
+        """Matches the lines in the output with a number of patterns, see
+        CheckOutput.match_any(...).
+
+        :param patterns: List of patterns as bytes or strings
+
+        :return: True if one or more of the patterns are found in the output
+                 lines.
+        """
+        regex = _compile(patterns)
+        return any(regex.match(self.data, start, end) for start, end in self._spans())
+
+    def match_all(self, patterns):
+        """Matches the lines in the output with a number of patterns in a
+        single pass, see CheckOutput.match_all(...).
+
+        :param patterns: List of patterns as bytes or strings
+
+        :return: True if every pattern is found in one or more of the output
+                 lines.
+        """
+        remaining = [_compile([pattern]) for pattern in dict.fromkeys(patterns)]
+
+        for start, end in self._spans():
+            remaining = [r for r in remaining if not r.match(self.data, start, end)]
+
+            if not remaining:
+                return True
+
+        return not remaining
+
+    def __len__(self):
+        """:return: The number of lines in the output"""
+        return sum(1 for _ in self._spans())
+
+    def __getitem__(self, key):
+        """Get a line, or a slice of the lines, of the output.
+
+        :param key: The number of the line or a slice
+        :return: The line as bytes, or a CheckOutputBytes with the lines of
+            the slice
+        """
+        spans = list(self._spans())
+
+        if isinstance(key, slice):
+            return CheckOutputBytes(b"".join(self._line(s) + b"\n" for s in spans[key]))
+
+        return self._line(spans[key])
+
+    def __iter__(self):
+        """Iterate over the lines in the output as bytes."""
+        for span in self._spans():
+            yield self._line(span)
+
+    def __bytes__(self):
+        """:return: The output as bytes"""
+        return bytes(self.data)
+
+    def __str__(self):
+        """
+        Generate a single string representation of the output, decoded with
+        the preferred encoding of the locale.
+
+        :return: A string representing the output.
+        """
+        text = bytes(self.data).decode(
+            locale.getpreferredencoding(False), errors="replace"
+        )
+        return "\n".join(text.splitlines())
+
+    def __repr__(self):
+        """
+        Generate a string representation of this object for pretty prints.
+
+        :return: A string representing the output.
+        """
+        return 'CheckOutputBytes: "{}"'.format(self)
+
+    def _line(self, span):
+        start, end = span
+        return bytes(self.data[start:end])
+
+    @staticmethod
+    def _compile(patterns):
+        # The lines are bytes, see _compile(...) below
+        return _compile(patterns)
+
+    def _lines(self):
+        # Matching is case sensitive, the lines are not normalized
+        return iter(self)
+
+    def _searchable(self, patterns):
+        # The lines are always matched one at a time
+        return False
+
+    def _spans(self):
+        """Iterate over the start and end of each line in the output,
+        without the line ending."""
+        data = self.data
+        start = 0
+
+        while start < len(data):
+            newline = _NEWLINE.search(data, start)
+            end = newline.start() if newline else len(data)
+            next_start = end + 1
+
+            if end > start and data[end - 1] == ord("\r"):
+                end -= 1
+
+            yield start, end
+            start = next_start
+
+
+def _compile(patterns):
+    """Compile a list of patterns into a single regular expression matching
+    bytes, see checkoutput._compile(...)."""
+    encoding = locale.getpreferredencoding(False)
+    regexes = []
+
+    for pattern in patterns:
+        if isinstance(pattern, str):
+            pattern = pattern.encode(encoding)
+
+        # Latin-1 maps every byte to the character with the same code, so
+        # the translated pattern encodes back to the same bytes
+        regexes.append(fnmatch.translate(pattern.decode("latin-1")))
+
+    regex = "|".join(regexes) or "(?!)"
+    return re.compile(regex.encode("latin-1"))
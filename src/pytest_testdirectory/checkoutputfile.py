@@ -0,0 +1,112 @@
+import locale
+import os
+import pathlib
+
+from . import checkoutput
+
+
+class CheckOutputFile(checkoutput.CheckOutput):
+    """Stores the output of a command which was spooled to a file.
+
+    The output is never loaded into memory as a whole. Matching reads the
+    file one line at a time and the string representation only contains
+    the beginning and the end of the output if it is large.
+
+    Attributes:
+
+    :output: List of strings representing the output (split by newlines),
+        read from the file when accessed
+    :path: The path to the file containing the output as a pathlib.Path
+    :encoding: The encoding of the output
+    :errors: How decoding errors are handled, see bytes.decode(...)
+
+    """
+
+    __slots__ = ("path", "encoding", "errors")
+
+    # The maximum number of bytes of output included by __str__
+    max_str_size = 64 * 1024
+
+    def __init__(self, path, encoding=None, errors=None):
+        """Creates a new CheckOutputFile object
+
+        :param path: The path to the file containing the output as a
+            string or pathlib.Path
+        :param encoding: The encoding of the output, if None the preferred
+            encoding of the locale is used
+        :param errors: How decoding errors are handled, if None invalid
+            bytes are replaced, as the output is only decoded when it is
+            checked
+        """
+        self.path = pathlib.Path(path)
+        self.encoding = encoding or locale.getpreferredencoding(False)
+        self.errors = errors or "replace"
+
+    @property
+    def output(self):
+        """List of strings representing the output (split by newlines),
+        read from the file when accessed."""
+        return list(self)
+
+    @property
+    def compressed(self):
+        """False, the output is never stored compressed"""
+        return False
+
+    def __iter__(self):
+        """Iterate over the lines in the output, one line at a time. The
+        lines are split by str.splitlines(...) like CheckOutput does."""
+        with open(
+            self.path, "r", encoding=self.encoding, errors=self.errors, newline=""
+        ) as output:
+            # The file is read in lines ending with \n, \r or \r\n, which
+            # may contain the other line endings of str.splitlines(...)
+            for line in output:
+                yield from line.splitlines()
+
+    def _indexed(self):
+        """:return: A CheckOutput with the whole output loaded into memory,
+        only used to count, index and slice the lines"""
+        return checkoutput.CheckOutput(checkoutput._join(self))
+
+    def _searchable(self, patterns):
+        # The lines are always matched one at a time
+        return False
+
+    def __str__(self):
+        """
+        Generate a string representation of the output. If the output is
+        larger than max_str_size bytes only the beginning and the end of the
+        output is included.
+
+        :return: A string representing the output.
+        """
+        size = os.path.getsize(self.path)
+
+        with open(self.path, "rb") as output:
+            if size <= self.max_str_size:
+                return self._decode(output.read())
+
+            half = self.max_str_size // 2
+            head = output.read(half)
+            output.seek(size - half)
+            tail = output.read(half)
+
+        return "{}\n[... {} bytes omitted, see {} ...]\n{}".format(
+            self._decode(head), size - 2 * half, self.path, self._decode(tail)
+        )
+
+    def __repr__(self):
+        """
+        Generate a string representation of this object for pretty prints.
+
+        :return: A string representing the output.
+        """
+        return 'CheckOutputFile: "{}"'.format(self)
+
+    def _decode(self, data):
+        """Decode the raw output the same way as the lines are read, except
+        that invalid bytes are always replaced, as the head and tail may
+        split a character."""
+        text = data.decode(self.encoding, errors="replace")
+        return "\n".join(text.splitlines())
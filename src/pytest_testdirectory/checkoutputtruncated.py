@@ -0,0 +1,59 @@
+from . import checkoutput
+
+
+class CheckOutputTruncated(checkoutput.CheckOutput):
+    """Stores the beginning and/or the end of the output of a command, see
+    the head and tail arguments of TestDirectory.run(...).
+
+    Only the retained lines are matched. The string representation marks
+    where lines were omitted and how many.
+
+    Attributes:
+
+    :output: List of strings with the retained lines, created when accessed
+    :head: The number of lines in output from the beginning of the output
+    :omitted_lines: The number of lines which were not retained
+    :omitted_bytes: The number of bytes which were not retained
+    """
+
+    __slots__ = ("head", "omitted_lines", "omitted_bytes")
+
+    def __init__(self, head, tail, omitted_lines, omitted_bytes):
+        """Creates a new CheckOutputTruncated object
+
+        :param head: List of strings with the lines from the beginning of
+            the output
+        :param tail: List of strings with the lines from the end of the
+            output
+        :param omitted_lines: The number of lines between head and tail
+        :param omitted_bytes: The number of bytes between head and tail
+        """
+        super(CheckOutputTruncated, self).__init__(
+            checkoutput._join(list(head) + list(tail))
+        )
+        self.head = len(head)
+        self.omitted_lines = omitted_lines
+        self.omitted_bytes = omitted_bytes
+
+    def __str__(self):
+        """
+        Generate a string representation of the retained output.
+
+        :return: A string representing the output.
+        """
+        if not self.omitted_lines:
+            return "\n".join(self)
+
+        marker = "[... {} lines ({} bytes) omitted ...]".format(
+            self.omitted_lines, self.omitted_bytes
+        )
+        lines = self.output
+        return "\n".join(lines[: self.head] + [marker] + lines[self.head :])
+
+    def __repr__(self):
+        """
+        Generate a string representation of this object for pretty prints.
+
+        :return: A string representing the output.
+        """
+        return 'CheckOutputTruncated: "{}"'.format(self)
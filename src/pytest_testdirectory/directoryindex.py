@@ -0,0 +1,96 @@
+import fnmatch
+import os
+import re
+
+from . import snapshot
+
+
+class DirectoryIndex:
+    """In memory index of the paths in a directory tree, built from a single
+    walk of the tree, see Snapshot.create(...).
+
+    Glob patterns are matched against the index one path component at a
+    time like pathlib.Path.glob(...) and glob.glob(...) do, but without
+    accessing the file system.
+
+    Attributes:
+
+    :path: The root of the directory tree as a string
+    """
+
+    def __init__(self, path):
+        """Create a new DirectoryIndex instance by walking the tree.
+
+        :param path: The root of the directory tree as a string or
+            pathlib.Path
+        """
+        self.path = str(path)
+
+        # Maps the components of each path to its kind, see Snapshot
+        self.kinds = {}
+
+        # Maps the components of each directory to the names in it
+        self.children = {(): []}
+
+        for relative, entry in snapshot.Snapshot.create(path=path).entries.items():
+            parts = tuple(os.path.normcase(part) for part in relative.split("/"))
+            kind = entry[0]
+
+            if kind == "link" and os.path.isdir(os.path.join(self.path, relative)):
+                # The walk does not follow symlinks, so the content of the
+                # linked directory is not in the index
+                kind = "linkdir"
+
+            self.kinds[parts] = kind
+            self.children.setdefault(parts[:-1], []).append(parts[-1])
+
+    def glob(self, pattern, hidden=True):
+        """Find the paths matching a glob pattern.
+
+        :param pattern: The pattern relative to the root as a string or
+            pathlib.Path
+        :param hidden: If False wildcards do not match names starting with
+            a dot, like glob.glob(...)
+        :return: List of the matching paths relative to the root using / as
+            separator. None if the pattern cannot be answered from the index
+            e.g. if it uses ** or traverses a symlinked directory.
+        """
+        pattern = str(pattern)
+
+        if os.path.isabs(pattern):
+            return None
+
+        parts = [
+            os.path.normcase(part) for part in pattern.replace(os.sep, "/").split("/")
+        ]
+
+        if any(part in ("**", ".", "..") for part in parts):
+            return None
+
+        # Ignore empty components e.g. from a trailing separator
+        parts = [part for part in parts if part]
+        matches = [()]
+
+        for part in parts:
+            if any(self.kinds.get(match) == "linkdir" for match in matches):
+                return None
+
+            if re.search(r"[*?[]", part) is None:
+                matches = [
+                    match + (part,)
+                    for match in matches
+                    if match + (part,) in self.kinds
+                ]
+                continue
+
+            regex = re.compile(fnmatch.translate(part))
+            skip_hidden = not hidden and not part.startswith(".")
+
+            matches = [
+                match + (name,)
+                for match in matches
+                for name in self.children.get(match, [])
+                if regex.match(name) and not (skip_hidden and name.startswith("."))
+            ]
+
+        return ["/".join(match) for match in matches if match]
@@ -0,0 +1,151 @@
+import os
+import sys
+
+
+class EnvironmentOverlay:
+    """Changes to the environment variables of the commands run in a test
+    directory, without changing the environment of the test itself.
+
+    Only the changes are stored. The environment of the commands is
+    os.environ with the changes of the parent overlay and then of this
+    overlay applied. It is computed when a command is run after a change
+    and reused until the overlays or os.environ change again. Without any
+    changes the commands simply inherit the environment of the test.
+
+    Example::
+
+        def test_tool(testdirectory):
+            testdirectory.env.set("TOOL_CONFIG", "config.ini")
+            testdirectory.env.prepend_path(testdirectory.mkdir("bin").path())
+            testdirectory.env.unset("HOME")
+
+            testdirectory.run("tool --version")
+
+    Attributes:
+
+    :parent: The EnvironmentOverlay applied before this one or None
+    """
+
+    def __init__(self, parent=None):
+        """Create a new EnvironmentOverlay object without any changes.
+
+        :param parent: The EnvironmentOverlay applied before this one or None
+        """
+        self.parent = parent
+
+        # List of the changes in the order they were made
+        self.changes = []
+
+        # Incremented on every change to invalidate the cached environment
+        self.version = 0
+
+        self._cached = None
+        self._cached_key = None
+        self._cached_base = None
+
+    def set(self, name, value):
+        """Set an environment variable.
+
+        :param name: The name of the variable
+        :param value: The value as a string or e.g. a pathlib.Path
+        """
+        self._change(("set", self._name(name), str(value)))
+
+    def unset(self, name):
+        """Remove an environment variable, if it is set.
+
+        :param name: The name of the variable
+        """
+        self._change(("unset", self._name(name), None))
+
+    def prepend_path(self, path, name="PATH"):
+        """Put a path first in a search path variable like PATH.
+
+        :param path: The path as a string or pathlib.Path
+        :param name: The name of the variable e.g. PATH or PYTHONPATH
+        """
+        self._change(("prepend", self._name(name), str(path)))
+
+    def clear(self):
+        """Remove the changes made to this overlay."""
+        self._change(None)
+
+    def environ(self):
+        """Compute the environment with the changes applied.
+
+        The result is cached and shared by the commands, it must not be
+        modified.
+
+        :return: Dict of environment variables or None if neither this
+            overlay nor its parents change anything
+        """
+        if not self._has_changes():
+            return None
+
+        key = self._key()
+
+        # The raw data of os.environ is cheap to compare, unlike the decoded
+        # variables os.environ.copy() builds
+        base = getattr(os.environ, "_data", None)
+
+        if (
+            self._cached is not None
+            and self._cached_key == key
+            and base is not None
+            and self._cached_base == base
+        ):
+            return self._cached
+
+        env = os.environ.copy()
+        self._apply(env)
+
+        self._cached = env
+        self._cached_key = key
+        self._cached_base = None if base is None else dict(base)
+
+        return env
+
+    def _has_changes(self):
+        if self.changes:
+            return True
+
+        return self.parent is not None and self.parent._has_changes()
+
+    def _key(self):
+        """:return: The versions of this overlay and its parents, which
+        changes whenever one of them changes"""
+        if self.parent is None:
+            return (self.version,)
+
+        return (self.version,) + self.parent._key()
+
+    def _apply(self, env):
+        if self.parent is not None:
+            self.parent._apply(env)
+
+        for action, name, value in self.changes:
+            if action == "set":
+                env[name] = value
+            elif action == "unset":
+                env.pop(name, None)
+            elif env.get(name):
+                env[name] = value + os.pathsep + env[name]
+            else:
+                env[name] = value
+
+    def _change(self, change):
+        if change is None:
+            self.changes = []
+        else:
+            self.changes.append(change)
+
+        self.version += 1
+
+    @staticmethod
+    def _name(name):
+        # The names are case insensitive on Windows, where os.environ
+        # stores them in upper case
+        if sys.platform == "win32":
+            return name.upper()
+
+        return name
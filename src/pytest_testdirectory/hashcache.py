@@ -0,0 +1,121 @@
+import json
+import os
+import pathlib
+import tempfile
+import threading
+
+from . import snapshot
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class HashCache:
+    """Cache of the SHA-256 digests of files, e.g. of reference trees which
+    rarely change.
+
+    A digest is reused as long as the size, modification time and inode of
+    the file are the same as when it was hashed. The cache can be stored in
+    a JSON file, such that it persists between test sessions. The
+    testdirectory_hashcache fixture stores it in the pytest cache directory.
+
+    Several processes, e.g. the pytest-xdist workers, may share the file.
+    Saving merges the entries with the ones stored by the other processes,
+    and drops the entries of files which no longer exist.
+
+    Attributes:
+
+    :path: The JSON file the cache is stored in as a pathlib.Path or None
+    :entries: Dict mapping the absolute path of each file to a list with
+        its size, modification time, inode and digest
+    """
+
+    def __init__(self, path=None):
+        """Create a new HashCache object, loading the entries stored in the
+        JSON file if it exists.
+
+        :param path: The JSON file the cache is stored in as a string or
+            pathlib.Path, or None to only keep the cache in memory
+        """
+        self.path = None if path is None else pathlib.Path(path)
+        self.entries = {}
+        self.lock = threading.Lock()
+
+        # The paths hashed since the cache was loaded or saved
+        self._updated = set()
+
+        if self.path is not None:
+            self.entries = self._load()
+
+    def hash_file(self, path):
+        """Compute the SHA-256 hex digest of a file, or reuse the digest
+        computed earlier if the file did not change.
+
+        :param path: The path to the file as a string or pathlib.Path
+        :return: The hex digest as a string
+        """
+        path = os.path.abspath(path)
+        info = os.stat(path)
+        key = [info.st_size, info.st_mtime_ns, info.st_ino]
+
+        with self.lock:
+            entry = self.entries.get(path)
+
+        if entry is not None and entry[:3] == key:
+            return entry[3]
+
+        digest = snapshot.hash_file(path)
+
+        with self.lock:
+            self.entries[path] = key + [digest]
+            self._updated.add(path)
+
+        return digest
+
+    def save(self):
+        """Store the cache in the JSON file, if it changed.
+
+        The entries are merged with the ones in the file, while holding a
+        lock on it, so the entries stored by other processes are kept. The
+        file is replaced atomically, so concurrent sessions never read a
+        partially written cache."""
+        if self.path is None or not self._updated:
+            return
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        with open(self.path.with_suffix(".lock"), "w") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+
+            entries = self._load()
+
+            with self.lock:
+                entries.update((path, self.entries[path]) for path in self._updated)
+                self._updated = set()
+
+            # Removed files would otherwise stay in the cache forever
+            entries = {
+                path: entry for path, entry in entries.items() if os.path.exists(path)
+            }
+
+            fd, temporary = tempfile.mkstemp(dir=self.path.parent, suffix=".tmp")
+
+            with os.fdopen(fd, "w") as output:
+                json.dump(entries, output)
+
+            os.replace(temporary, self.path)
+
+    def _load(self):
+        """:return: The entries stored in the JSON file, or an empty dict if
+        there are none"""
+        try:
+            return json.loads(self.path.read_text())
+        except OSError:
+            # E.g. the file does not exist yet
+            return {}
+        except ValueError:
+            # A corrupt cache is simply rebuilt
+            return {}
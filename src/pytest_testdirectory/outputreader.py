@@ -0,0 +1,234 @@
+import collections
+import io
+import locale
+import os
+import threading
+
+from . import checkoutput
+
+
+class OutputReader:
+    """Reads the output of a running command in a background thread.
+
+    The output is either kept in memory or written to a file. While reading,
+    each complete line can be matched against a compiled pattern, see
+    checkoutput.CheckOutput.match_any(...).
+
+    Attributes:
+
+    :matched: True if a line matched the pattern
+    :closed: True when the stream has been read to the end
+    """
+
+    # The number of bytes to read from the stream at a time
+    chunk_size = 64 * 1024
+
+    def __init__(
+        self,
+        stream,
+        condition=None,
+        regex=None,
+        path=None,
+        encoding=None,
+        errors=None,
+        head=None,
+        tail=None,
+    ):
+        """Create a new OutputReader and start reading.
+
+        :param stream: The stream to read e.g. the stdout of a Popen object
+        :param condition: A threading.Condition which is notified when a line
+            matches or the stream is closed or None
+        :param regex: Compiled regular expression to match each line with
+            or None
+        :param path: If not None the output is written to this file instead
+            of being kept in memory
+        :param encoding: The encoding of the output, if None the preferred
+            encoding of the locale is used
+        :param errors: How decoding errors are handled, see bytes.decode(...)
+        :param head: If not None only this number of lines from the beginning
+            of the output are kept, see truncated(...)
+        :param tail: If not None only this number of lines from the end of
+            the output are kept, see truncated(...)
+        """
+        self.stream = stream
+        self.condition = condition if condition is not None else threading.Condition()
+        self.regex = regex
+        self.path = path
+        self.matched = False
+        self.closed = False
+
+        self.encoding = encoding or locale.getpreferredencoding(False)
+        self.errors = errors or "strict"
+
+        self.head = head
+        self.tail = tail
+
+        # The amount of output and the chunks kept when truncating
+        self.size = 0
+        self.newlines = 0
+        self.last = b""
+        self.head_chunks = []
+        self.head_newlines = 0
+        self.head_full = not head
+        self.tail_chunks = collections.deque()
+        self.tail_newlines = 0
+        self.tail_trimmed = False
+
+        if head is not None or tail is not None:
+            self.sink = None
+        elif path is None:
+            self.sink = io.BytesIO()
+        else:
+            self.sink = open(path, "wb")
+
+        self.thread = threading.Thread(target=self._read, daemon=True)
+        self.thread.start()
+
+    def join(self, timeout=None):
+        """Wait for the stream to be read to the end.
+
+        :param timeout: The maximum time to wait in seconds or None
+        """
+        self.thread.join(timeout)
+
+    def output(self):
+        """:return: The output as a string or None if it was written to a
+        file"""
+        if self.path is not None:
+            return None
+
+        return self.sink.getvalue().decode(self.encoding, self.errors)
+
+    def truncated(self):
+        """:return: A tuple with the lines kept from the beginning and the
+        end of the output as strings, and the number of lines and bytes
+        between them"""
+        lines = self.newlines + (1 if self.last not in (b"", b"\n") else 0)
+
+        head = []
+        rest = b""
+
+        if self.head:
+            parts = b"".join(self.head_chunks).split(b"\n", self.head)
+
+            if len(parts) > self.head:
+                # The output after the head lines
+                rest = parts.pop()
+            elif parts[-1] == b"":
+                # The output ended with a newline
+                parts.pop()
+
+            head = parts
+
+        tail = []
+
+        if self.tail:
+            data = b"".join(chunk for chunk, _ in self.tail_chunks)
+
+            if not self.tail_trimmed:
+                data = rest + data
+
+            if data:
+                tail = data.split(b"\n")
+                if tail[-1] == b"":
+                    tail.pop()
+                tail = tail[-self.tail :]
+
+        kept = sum(len(line) + 1 for line in head + tail)
+
+        if self.last not in (b"", b"\n") and (tail or len(head) == lines):
+            # The last line is kept, but has no newline
+            kept -= 1
+
+        return (
+            [self._decode(line) for line in head],
+            [self._decode(line) for line in tail],
+            lines - len(head) - len(tail),
+            self.size - kept,
+        )
+
+    def data(self):
+        """:return: The output as a memoryview of the bytes read, without
+        copying or decoding it, or None if it was written to a file"""
+        if self.path is not None:
+            return None
+
+        return self.sink.getbuffer()
+
+    def _read(self):
+        pending = b""
+
+        try:
+            while True:
+                data = os.read(self.stream.fileno(), self.chunk_size)
+
+                if not data:
+                    break
+
+                if self.sink is None:
+                    self._keep(data)
+                else:
+                    self.sink.write(data)
+
+                if self.regex is None or self.matched:
+                    continue
+
+                # Only match complete lines
+                lines = (pending + data).split(b"\n")
+                pending = lines.pop()
+                self._match(lines)
+
+            if pending and not self.matched:
+                self._match([pending])
+
+        finally:
+            self.stream.close()
+
+            if self.path is not None and self.sink is not None:
+                self.sink.close()
+
+            with self.condition:
+                self.closed = True
+                self.condition.notify_all()
+
+    def _keep(self, data):
+        """Keep the chunks of output needed for truncated(...). The chunks
+        are only split into lines at the end."""
+        newlines = data.count(b"\n")
+        self.size += len(data)
+        self.newlines += newlines
+        self.last = data[-1:]
+
+        if not self.head_full:
+            self.head_chunks.append(data)
+            self.head_newlines += newlines
+            self.head_full = self.head_newlines >= self.head
+            return
+
+        if not self.tail:
+            return
+
+        self.tail_chunks.append((data, newlines))
+        self.tail_newlines += newlines
+
+        # Drop the oldest chunks while the others hold more than tail lines
+        while (
+            len(self.tail_chunks) > 1
+            and self.tail_newlines - self.tail_chunks[0][1] > self.tail
+        ):
+            self.tail_newlines -= self.tail_chunks.popleft()[1]
+            self.tail_trimmed = True
+
+    def _decode(self, line):
+        return line.decode(self.encoding, self.errors).rstrip("\r")
+
+    def _match(self, lines):
+        for line in lines:
+            line = line.decode(self.encoding, errors="replace").rstrip("\r")
+
+            if self.regex.match(checkoutput._normcase(line)):
+                with self.condition:
+                    self.matched = True
+                    self.condition.notify_all()
+                return
@@ -0,0 +1,101 @@
+import concurrent.futures
+import os
+import shutil
+
+
+def copy2(source, destination):
+    """Copy a file and its metadata like shutil.copy2(...).
+
+    The data is copied with os.copy_file_range(...) when available, which
+    lets the kernel copy the data without passing it through user space and
+    allows server side copies on network file systems. Otherwise
+    shutil.copyfile(...) is used, which uses os.sendfile(...) where it can.
+
+    :param source: The file to copy as a string or pathlib.Path
+    :param destination: The path of the copy as a string or pathlib.Path
+    :return: The destination
+    :raises: shutil.SameFileError if the source and destination are the
+        same file
+    """
+    if os.path.isdir(destination):
+        destination = os.path.join(destination, os.path.basename(source))
+
+    # The destination is truncated when opened, so check first like
+    # shutil.copyfile(...) does
+    if os.path.exists(destination) and os.path.samefile(source, destination):
+        raise shutil.SameFileError(f"{source!r} and {destination!r} are the same file")
+
+    if not _copy_file_range(source=source, destination=destination):
+        shutil.copyfile(source, destination)
+
+    shutil.copystat(source, destination)
+    return destination
+
+
+def copytree(source, destination, workers=None, copy_function=copy2):
+    """Copy a directory tree using a pool of threads.
+
+    The directories are created by shutil.copytree(...) while the files
+    are copied concurrently, which hides the per file latency of e.g. NVMe
+    drives and network file systems. The metadata is preserved the same
+    way as by shutil.copytree(...).
+
+    :param source: The directory to copy as a string or pathlib.Path
+    :param destination: The path of the copy as a string or pathlib.Path,
+        it must not exist.
+    :param workers: The number of threads copying files. If None the
+        default of concurrent.futures.ThreadPoolExecutor is used. If 1 the
+        files are copied one at a time by shutil.copytree(...).
+    :param copy_function: The function used to copy each file
+    :return: The destination
+    """
+    if workers == 1:
+        return shutil.copytree(source, destination, copy_function=copy_function)
+
+    copies = []
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+
+        def submit(src, dst):
+            copies.append((src, dst, pool.submit(copy_function, src, dst)))
+            return dst
+
+        shutil.copytree(source, destination, copy_function=submit)
+
+    errors = [
+        (src, dst, str(future.exception()))
+        for src, dst, future in copies
+        if future.exception() is not None
+    ]
+
+    if errors:
+        raise shutil.Error(errors)
+
+    # The files were created after shutil.copytree(...) copied the
+    # metadata of the directories, so copy it again
+    for root, _, _ in os.walk(destination, topdown=False):
+        relative = os.path.relpath(root, destination)
+        shutil.copystat(os.path.join(source, relative), root)
+
+    return destination
+
+
+def _copy_file_range(source, destination):
+    """Copy the data of a file with os.copy_file_range(...).
+
+    :return: True if the data was copied, False if os.copy_file_range(...)
+        is not supported for the files.
+    """
+    if not hasattr(os, "copy_file_range"):
+        return False
+
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        try:
+            while os.copy_file_range(src.fileno(), dst.fileno(), 1 << 30) > 0:
+                pass
+        except OSError:
+            # E.g. the file systems do not support it or the files are on
+            # different file systems on older kernels
+            return False
+
+    return True
@@ -0,0 +1,112 @@
+import contextlib
+import pathlib
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class ProcessLimit:
+    """Limits the number of commands running at the same time across all the
+    processes of a test session e.g. the pytest-xdist workers.
+
+    The limit is a number of slots, each a lock file in a directory shared
+    by the processes. A command takes one or more slots while it runs, so a
+    heavy command can be given a larger weight than a light one. The slots
+    are locked with fcntl.flock(...), which the operating system releases
+    if a process dies, so a crashed worker cannot leak slots.
+
+    Only one process at a time collects slots, which makes the slots go to
+    the waiting commands in turn and prevents two heavy commands from each
+    holding part of the slots they need.
+
+    On platforms without fcntl (i.e. Windows) the limit is not enforced.
+
+    Attributes:
+
+    :path: The directory containing the lock files as a pathlib.Path
+    :slots: The number of slots
+    """
+
+    # The time in seconds between checking for free slots
+    poll_interval = 0.01
+
+    def __init__(self, path, slots):
+        """Create a new ProcessLimit object
+
+        :param path: The directory containing the lock files as a string or
+            pathlib.Path. It is created if it does not exist.
+        :param slots: The number of slots i.e. the total weight of the
+            commands running at the same time
+        """
+        if slots < 1:
+            raise ValueError(f"The number of slots must be positive not {slots}")
+
+        self.path = pathlib.Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.slots = slots
+
+    @contextlib.contextmanager
+    def acquire(self, weight=1):
+        """Wait for free slots and hold them until the context is left.
+
+        Example::
+
+            with limit.acquire(weight=4):
+                subprocess.run(["make", "-j4"])
+
+        :param weight: The number of slots to take. A weight larger than the
+            number of slots takes all the slots.
+        """
+        if fcntl is None or weight <= 0:
+            yield
+            return
+
+        weight = min(weight, self.slots)
+
+        # Maps the index of each held slot to its open lock file
+        held = {}
+
+        try:
+            with open(self.path / "collect.lock", "w") as collect:
+                fcntl.flock(collect.fileno(), fcntl.LOCK_EX)
+
+                while True:
+                    for slot in range(self.slots):
+                        if len(held) == weight:
+                            break
+                        if slot in held:
+                            continue
+
+                        lock = self._try_lock(slot)
+                        if lock is not None:
+                            held[slot] = lock
+
+                    if len(held) == weight:
+                        break
+
+                    time.sleep(self.poll_interval)
+
+            yield
+
+        finally:
+            for lock in held.values():
+                # Closing the file releases the lock
+                lock.close()
+
+    def _try_lock(self, slot):
+        """Lock a slot without blocking.
+
+        :return: The open lock file, or None if the slot is taken
+        """
+        lock = open(self.path / f"slot-{slot}.lock", "w")
+
+        try:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock.close()
+            return None
+
+        return lock
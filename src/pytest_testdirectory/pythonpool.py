@@ -0,0 +1,204 @@
+import concurrent.futures
+import json
+import os
+import pathlib
+import subprocess
+import sys
+import threading
+import types
+
+from . import resourceusage
+
+
+class PythonPool:
+    """Runs Python modules and entry points in interpreters forked from a
+    warm server process, the zygote.
+
+    Starting a Python command line tool usually costs more time than
+    running it: the interpreter starts and the tool imports its
+    dependencies. The zygote is started once and imports the modules to
+    preload. Each run forks a child from the zygote, so it starts with the
+    modules already imported and from the same clean state, no matter what
+    earlier runs did.
+
+    The package of each module and the module of each entry point run are
+    imported in the zygote as well, so later runs of the same tool start
+    warm.
+
+    The modules imported by the zygote are not reloaded if their source
+    changes during the session, and environment variables only read when
+    the interpreter starts, except PYTHONPATH, have no effect.
+
+    Forking is not supported on Windows and is unsafe on macOS, where the
+    pool is not supported, see supported.
+
+    Attributes:
+
+    :preload: The modules imported by the zygote when it starts
+    """
+
+    # True if the pool can be used on this platform
+    supported = hasattr(os, "fork") and sys.platform != "darwin"
+
+    def __init__(self, preload=()):
+        """Create a new PythonPool object, the zygote is started by the
+        first run.
+
+        :param preload: The names of the modules the zygote imports when it
+            starts
+        """
+        self.preload = list(preload)
+
+        self.lock = threading.Lock()
+        self.zygote = None
+        self.reader = None
+        self.futures = {}
+        self.next_id = 0
+        self.warm = set()
+
+    def run(self, target, args, cwd, env, stdout, stderr, timeout=None):
+        """Run a module or entry point in a forked interpreter.
+
+        :param target: The module to run like python -m, e.g. "pkg.cli", or
+            an entry point, e.g. "pkg.cli:main"
+        :param args: The list of arguments
+        :param cwd: The working directory as a string
+        :param env: The environment variables as a dict
+        :param stdout: The path of the file the stdout is written to
+        :param stderr: The path of the file the stderr is written to
+        :param timeout: The maximum time to wait in seconds or None
+
+        :return: A tuple with the return code, a ResourceUsage object and
+            True if the run was killed after the timeout
+        """
+        module = target.split(":")[0]
+
+        with self.lock:
+            if self.zygote is None:
+                self._start()
+
+            # Warm the zygote for the next run. A module run as a script
+            # must not be imported, as it may run code when it is imported,
+            # so only its package is.
+            warm = module if ":" in target else module.rpartition(".")[0]
+            if warm and warm not in self.warm:
+                self.warm.add(warm)
+                self._send({"import": warm})
+
+            id = self.next_id
+            self.next_id += 1
+
+            future = concurrent.futures.Future()
+            self.futures[id] = future
+
+            self._send(
+                {
+                    "id": id,
+                    "target": target,
+                    "args": list(args),
+                    "cwd": str(cwd),
+                    "env": dict(env),
+                    "stdout": str(stdout),
+                    "stderr": str(stderr),
+                }
+            )
+
+        timed_out = False
+
+        try:
+            response = future.result(timeout=timeout)
+        except concurrent.futures.TimeoutError:
+            with self.lock:
+                if self.zygote is not None:
+                    self._send({"kill": id})
+
+            # The zygote responds when the killed child has been reaped
+            try:
+                response = future.result(timeout=timeout)
+            except concurrent.futures.TimeoutError:
+                raise RuntimeError(
+                    f"The Python zygote did not respond to the kill of {target}"
+                )
+
+            timed_out = True
+
+        resources = resourceusage.ResourceUsage.from_rusage(
+            types.SimpleNamespace(**response["rusage"])
+        )
+        return response["returncode"], resources, timed_out
+
+    def close(self):
+        """Stop the zygote, killing the runs in progress."""
+        with self.lock:
+            zygote, self.zygote = self.zygote, None
+
+        if zygote is None:
+            return
+
+        zygote.stdin.close()
+        zygote.wait()
+        self.reader.join()
+
+    def _start(self):
+        self.zygote = subprocess.Popen(
+            [sys.executable, str(pathlib.Path(__file__).with_name("zygote.py"))]
+            + self.preload,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+
+        self.reader = threading.Thread(
+            target=self._read, args=(self.zygote.stdout,), daemon=True
+        )
+        self.reader.start()
+
+    def _send(self, request):
+        self.zygote.stdin.write(json.dumps(request).encode() + b"\n")
+        self.zygote.stdin.flush()
+
+    def _read(self, stream):
+        """Pass the responses of the zygote to the waiting runs."""
+        error = RuntimeError("The Python zygote exited")
+
+        try:
+            for line in stream:
+                try:
+                    response = json.loads(line)
+                    id = response["id"]
+                except (ValueError, TypeError, KeyError):
+                    error = RuntimeError(
+                        f"Invalid response from the Python zygote: {line!r}"
+                    )
+                    break
+
+                with self.lock:
+                    future = self.futures.pop(id, None)
+
+                if future is not None:
+                    future.set_result(response)
+
+        finally:
+            stream.close()
+
+            # The zygote exited or broke the protocol, fail the runs in
+            # progress. The next run starts a new zygote.
+            with self.lock:
+                futures, self.futures = self.futures, {}
+                zygote = self.zygote
+
+                if zygote is not None and zygote.stdout is stream:
+                    self.zygote = None
+                    self.warm = set()
+                else:
+                    zygote = None
+
+            if zygote is not None:
+                # Closing stdin stops the zygote and kills its children
+                try:
+                    zygote.stdin.close()
+                except OSError:
+                    pass
+                zygote.wait()
+
+            for future in futures.values():
+                future.set_exception(error)
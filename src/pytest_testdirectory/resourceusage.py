@@ -0,0 +1,94 @@
+import sys
+
+
+class ResourceUsage:
+    """Stores the resources used by a command and the processes it waited
+    for, as reported by os.wait4(...).
+
+    Attributes:
+
+    :user_time: The CPU time spent in user mode in seconds
+    :system_time: The CPU time spent in kernel mode in seconds
+    :max_rss: The maximum resident set size in bytes
+    :minor_faults: The number of page faults serviced without I/O
+    :major_faults: The number of page faults which required I/O
+    :voluntary_switches: The number of context switches because the
+        command waited e.g. for I/O
+    :involuntary_switches: The number of context switches because the
+        command was preempted
+    """
+
+    __slots__ = (
+        "user_time",
+        "system_time",
+        "max_rss",
+        "minor_faults",
+        "major_faults",
+        "voluntary_switches",
+        "involuntary_switches",
+    )
+
+    def __init__(
+        self,
+        user_time,
+        system_time,
+        max_rss,
+        minor_faults,
+        major_faults,
+        voluntary_switches,
+        involuntary_switches,
+    ):
+        """Create a new ResourceUsage object"""
+        self.user_time = user_time
+        self.system_time = system_time
+        self.max_rss = max_rss
+        self.minor_faults = minor_faults
+        self.major_faults = major_faults
+        self.voluntary_switches = voluntary_switches
+        self.involuntary_switches = involuntary_switches
+
+    @staticmethod
+    def from_rusage(rusage):
+        """Create a new ResourceUsage object from a resource.struct_rusage.
+
+        :param rusage: The resource usage e.g. returned by os.wait4(...)
+        :return: A ResourceUsage object
+        """
+        # Linux reports the maximum resident set size in KiB, macOS in bytes
+        max_rss = rusage.ru_maxrss
+        if sys.platform != "darwin":
+            max_rss *= 1024
+
+        return ResourceUsage(
+            user_time=rusage.ru_utime,
+            system_time=rusage.ru_stime,
+            max_rss=max_rss,
+            minor_faults=rusage.ru_minflt,
+            major_faults=rusage.ru_majflt,
+            voluntary_switches=rusage.ru_nvcsw,
+            involuntary_switches=rusage.ru_nivcsw,
+        )
+
+    @property
+    def cpu_time(self):
+        """:return: The CPU time spent in user and kernel mode in seconds"""
+        return self.user_time + self.system_time
+
+    def to_dict(self):
+        """:return: The resource usage as a dict e.g. for JSON reports"""
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __str__(self):
+        """Print the ResourceUsage object as a string"""
+        return (
+            "user {:.3f}s system {:.3f}s max rss {:.1f} MiB "
+            "faults {}/{} switches {}/{}".format(
+                self.user_time,
+                self.system_time,
+                self.max_rss / (1024 * 1024),
+                self.minor_faults,
+                self.major_faults,
+                self.voluntary_switches,
+                self.involuntary_switches,
+            )
+        )
@@ -0,0 +1,26 @@
+from . import runresulterror
+
+
+class RunManyError(runresulterror.RunResultError):
+    """Exception for TestDirectory::run_many
+
+    Attributes:
+
+    :errors: List of RunResultError objects, one for each failing command
+    :runresults: List of RunResult objects for all the commands in the
+        order they were submitted
+    :runresult: The RunResult object of the first failing command
+    """
+
+    def __init__(self, errors, runresults):
+        super(RunManyError, self).__init__(errors[0].runresult)
+
+        self.args = (
+            "{} of {} commands failed\n\n{}".format(
+                len(errors),
+                len(runresults),
+                "\n\n".join(str(error.runresult) for error in errors),
+            ),
+        )
+        self.errors = errors
+        self.runresults = runresults
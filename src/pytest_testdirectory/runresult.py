@@ -18,10 +18,37 @@ class RunResult:
     :stdout: The standard output stream generated by the command
     :stderr: The standard error stream generated by the command
     :returncode: The return code set after invoking the command
-    :time: The time it took to execute the command
+    :time: The time it took to execute the command in seconds, measured
+        with a monotonic clock
+    :diff: SnapshotDiff with the files and directories the command added,
+        removed or modified or None if not requested
+    :resources: ResourceUsage with the CPU time, memory, page faults and
+        context switches of the command or None if not available e.g. on
+        Windows
     """
 
-    def __init__(self, command, path, stdout, stderr, returncode, time):
+    __slots__ = (
+        "command",
+        "path",
+        "stdout",
+        "stderr",
+        "returncode",
+        "time",
+        "diff",
+        "resources",
+    )
+
+    def __init__(
+        self,
+        command,
+        path,
+        stdout,
+        stderr,
+        returncode,
+        time,
+        diff=None,
+        resources=None,
+    ):
         """Create a new RunResult object"""
 
         self.command = command
@@ -30,10 +57,12 @@ class RunResult:
         self.stderr = stderr
         self.returncode = returncode
         self.time = time
+        self.diff = diff
+        self.resources = resources
 
     def __str__(self):
         """Print the RunResult object as a string"""
-        return run_string.format(
+        result = run_string.format(
             self.command,
             self.path,
             self.stdout,
@@ -41,3 +70,8 @@ class RunResult:
             self.returncode,
             self.time,
         )
+
+        if self.diff is not None:
+            result += "\ndiff:\n{}".format(self.diff)
+
+        return result
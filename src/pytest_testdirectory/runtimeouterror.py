@@ -0,0 +1,22 @@
+from . import runresulterror
+
+
+class RunTimeoutError(runresulterror.RunResultError):
+    """Exception for TestDirctory::run when the command did not finish
+    within the timeout. The command has been killed and the runresult
+    contains the output collected until then.
+
+    Attributes:
+
+    :runresult: The RunResult object of the killed command
+    :timeout: The timeout in seconds
+    """
+
+    def __init__(self, runresult, timeout):
+        super(RunTimeoutError, self).__init__(runresult)
+
+        self.args = (
+            "Timeout after {} seconds, the command was killed after running "
+            "for {:.3f} seconds\n{}".format(timeout, runresult.time, runresult),
+        )
+        self.timeout = timeout
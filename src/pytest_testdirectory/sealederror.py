@@ -0,0 +1,17 @@
+class SealedError(Exception):
+    """Exception raised when a directory sealed with TestDirectory.seal(...)
+    was modified.
+
+    Attributes:
+
+    :path: The path of the sealed directory as a pathlib.Path
+    :diff: The SnapshotDiff with the added, removed and modified paths
+    """
+
+    def __init__(self, path, diff):
+        super(SealedError, self).__init__(
+            "The sealed directory {} was modified:\n{}".format(path, diff)
+        )
+
+        self.path = path
+        self.diff = diff
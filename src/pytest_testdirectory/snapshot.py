@@ -0,0 +1,131 @@
+import hashlib
+import os
+import stat
+
+from . import snapshotdiff
+
+
+class Snapshot:
+    """Index of the files and directories in a directory tree at a point in
+    time, created in a single walk of the tree.
+
+    Attributes:
+
+    :path: The root of the directory tree as a string
+    :entries: Dict mapping the path of each file and directory relative to
+        the root (using / as separator) to a tuple (kind, size, mtime_ns,
+        inode, digest). The kind is "file", "dir" or "link" and digest is the
+        SHA-256 hex digest of a file or None if the files were not hashed.
+    :hash: True if the content of the files was hashed
+    """
+
+    def __init__(self, path, entries, hash):
+        """Create a new Snapshot instance, see Snapshot.create(...).
+
+        :param path: The root of the directory tree as a string
+        :param entries: Dict with the entries of the snapshot
+        :param hash: True if the content of the files was hashed
+        """
+        self.path = path
+        self.entries = entries
+        self.hash = hash
+
+    @staticmethod
+    def create(path, hash=False, exclude=()):
+        """Take a snapshot of a directory tree. Symlinks are not followed.
+
+        :param path: The root of the directory tree as a string or
+            pathlib.Path
+        :param hash: If True the content of the files is hashed, such that
+            modifications which keep the size and modification time are
+            detected.
+        :param exclude: Paths to leave out of the snapshot
+        :return: A Snapshot object
+        """
+        path = str(path)
+        exclude = {str(excluded) for excluded in exclude}
+        entries = {}
+        stack = [(path, "")]
+
+        while stack:
+            directory, prefix = stack.pop()
+
+            with os.scandir(directory) as scan:
+                for entry in scan:
+                    if entry.path in exclude:
+                        continue
+
+                    info = entry.stat(follow_symlinks=False)
+                    relative = prefix + entry.name
+                    digest = None
+
+                    if stat.S_ISDIR(info.st_mode):
+                        kind = "dir"
+                        stack.append((entry.path, relative + "/"))
+                    elif stat.S_ISLNK(info.st_mode):
+                        kind = "link"
+                    else:
+                        kind = "file"
+                        if hash:
+                            digest = hash_file(entry.path)
+
+                    entries[relative] = (
+                        kind,
+                        info.st_size,
+                        info.st_mtime_ns,
+                        info.st_ino,
+                        digest,
+                    )
+
+        return Snapshot(path=path, entries=entries, hash=hash)
+
+    def diff(self, after):
+        """Compare this snapshot with a later snapshot of the same tree.
+
+        Directories are only reported as modified if they were replaced by
+        something else, changes to the files inside are reported for the
+        files themselves.
+
+        :param after: The later Snapshot
+        :return: A SnapshotDiff object
+        """
+        before = self.entries
+        after = after.entries
+
+        added = sorted(after.keys() - before.keys())
+        removed = sorted(before.keys() - after.keys())
+        modified = sorted(
+            relative
+            for relative in before.keys() & after.keys()
+            if self._modified(before[relative], after[relative])
+        )
+
+        return snapshotdiff.SnapshotDiff(
+            added=added, removed=removed, modified=modified
+        )
+
+    @staticmethod
+    def _modified(before, after):
+        if before[0] != after[0]:
+            return True
+
+        if before[0] == "dir":
+            return False
+
+        return before != after
+
+
+def hash_file(path, chunk_size=1024 * 1024):
+    """Compute the SHA-256 hex digest of a file reading it in chunks.
+
+    :param path: The path to the file as a string or pathlib.Path
+    :param chunk_size: The number of bytes to read at a time
+    :return: The hex digest as a string
+    """
+    digest = hashlib.sha256()
+
+    with open(path, "rb") as data:
+        for chunk in iter(lambda: data.read(chunk_size), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
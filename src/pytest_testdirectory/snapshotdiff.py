@@ -0,0 +1,32 @@
+class SnapshotDiff:
+    """Stores the differences between two snapshots of a directory tree.
+
+    Attributes:
+
+    :added: Sorted list of the paths added
+    :removed: Sorted list of the paths removed
+    :modified: Sorted list of the paths modified
+
+    The paths are relative to the root of the tree using / as separator.
+    """
+
+    def __init__(self, added, removed, modified):
+        """Create a new SnapshotDiff object"""
+        self.added = added
+        self.removed = removed
+        self.modified = modified
+
+    def __bool__(self):
+        """:return: True if anything changed"""
+        return bool(self.added or self.removed or self.modified)
+
+    def __str__(self):
+        """Print the SnapshotDiff object as a string"""
+        lines = []
+
+        for prefix, paths in (("+", self.added), ("-", self.removed)):
+            lines += [f"{prefix} {path}" for path in paths]
+
+        lines += [f"M {path}" for path in self.modified]
+
+        return "\n".join(lines)
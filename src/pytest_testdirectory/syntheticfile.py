@@ -0,0 +1,86 @@
+import os
+import random
+
+
+class SyntheticFile:
+    """Describes a generated file of a given size, for use with
+    TestDirectory.populate(...).
+
+    The data is generated and written a block at a time, so the file is
+    never held in memory as a whole. The content is one of:
+
+    - Pseudo random bytes from a seed, the same seed gives the same file.
+    - A repeated pattern of bytes, e.g. a line of text.
+    - Zeros, written as a sparse file where the file system supports it,
+      which costs the same no matter the size.
+
+    Example::
+
+        testdirectory.populate({
+            "random.bin": SyntheticFile(size=100 * 1024 * 1024, seed=42),
+            "log.txt": SyntheticFile(size=10 * 1024 * 1024, content="line\\n"),
+            "disk.img": SyntheticFile(size=4 * 1024**3, sparse=True),
+        })
+
+    Attributes:
+
+    :size: The size of the file in bytes
+    :content: The repeated pattern as bytes or None
+    :seed: The seed of the pseudo random bytes
+    :sparse: True if the file is zeros
+    """
+
+    # The number of bytes generated and written at a time
+    block_size = 1024 * 1024
+
+    def __init__(self, size, content=None, seed=0, sparse=False):
+        """Create a new SyntheticFile object
+
+        :param size: The size of the file in bytes
+        :param content: The pattern to repeat as bytes or a string encoded
+            as UTF-8, or None for pseudo random bytes
+        :param seed: The seed of the pseudo random bytes
+        :param sparse: If True the file is zeros
+        """
+        if isinstance(content, str):
+            content = content.encode("utf-8")
+
+        if content is not None and not content:
+            raise ValueError("The content to repeat must not be empty")
+
+        self.size = size
+        self.content = content
+        self.seed = seed
+        self.sparse = sparse
+
+    def write(self, fd):
+        """Write the file.
+
+        :param fd: The file descriptor of the empty file opened for writing
+        """
+        if self.sparse:
+            os.ftruncate(fd, self.size)
+            return
+
+        if self.content is not None:
+            # Repeat the pattern to a block once, then write the block
+            repeats = max(1, self.block_size // len(self.content))
+            block = self.content * repeats
+        else:
+            generator = random.Random(self.seed)
+
+        remaining = self.size
+
+        while remaining > 0:
+            if self.content is None:
+                # The same bytes as Random.randbytes(...), which requires
+                # Python 3.9
+                size = min(remaining, self.block_size)
+                block = generator.getrandbits(size * 8).to_bytes(size, "little")
+
+            view = memoryview(block)[:remaining]
+
+            while view:
+                written = os.write(fd, view)
+                view = view[written:]
+                remaining -= written
@@ -0,0 +1,188 @@
+import hashlib
+import os
+import pathlib
+import shutil
+import threading
+
+from . import parallelcopy
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# The Linux ioctl request for cloning a file i.e. creating a reflink
+FICLONE = 0x40049409
+
+
+class TemplateCache:
+    """Session wide cache of the files and directories copied into test
+    directories.
+
+    The first time a source is copied a pristine copy is stored in the cache.
+    Later copies of the same source are materialized from the cache as
+    reflinks, which share the data blocks with the cached copy until one of
+    them is modified. Creating a reflink costs the same no matter the file
+    size.
+
+    The cache is keyed on the path of the source and a fingerprint of the
+    size, modification time and mode of every file in it. If the source
+    changes the fingerprint changes and the cached copy is replaced.
+
+    Reflinks are created with the Linux FICLONE ioctl. If the file system
+    does not support reflinks (only e.g. Btrfs and XFS do) or the platform
+    is not Linux, the cache is bypassed and the source is copied directly
+    as caching would only add an extra copy.
+
+    Attributes:
+
+    :path: The directory where the cached copies are stored as a
+        pathlib.Path
+    :reflink: True if the file system supports reflinks
+    """
+
+    def __init__(self, path):
+        """Create a new TemplateCache instance.
+
+        :param path: The directory where the cached copies are stored as a
+            string or pathlib.Path. It should be on the same file system as
+            the test directories.
+        """
+        self.path = pathlib.Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.entries = {}
+
+        # A lock per source, so different sources are cached concurrently
+        self.locks = {}
+        self.reflink = self._probe_reflink()
+
+    def copy_dir(self, source, destination, workers=None):
+        """Copy a directory tree. Preserve file flags like shutil.copytree.
+
+        :param source: The directory to copy as a string or pathlib.Path
+        :param destination: The path of the copy as a string or pathlib.Path,
+            it must not exist.
+        :param workers: The number of threads copying files, see
+            parallelcopy.copytree(...)
+        """
+        if not self.reflink:
+            parallelcopy.copytree(source, destination, workers=workers)
+            return
+
+        cached = self._cached(
+            source=source, fingerprint=self._fingerprint_dir, workers=workers
+        )
+        parallelcopy.copytree(
+            cached, destination, workers=workers, copy_function=self._clone
+        )
+
+    def copy_file(self, source, destination):
+        """Copy a file. Preserve file flags like shutil.copy2.
+
+        :param source: The file to copy as a string or pathlib.Path
+        :param destination: The path of the copy as a string or pathlib.Path
+        """
+        if not self.reflink:
+            parallelcopy.copy2(source, destination)
+            return
+
+        cached = self._cached(source=source, fingerprint=self._fingerprint_file)
+        self._clone(cached, destination)
+
+    def _cached(self, source, fingerprint, workers=None):
+        """Get the cached copy of the source, copy it to the cache if it is
+        missing or outdated.
+
+        :return: The path to the cached copy as a pathlib.Path
+        """
+        source = pathlib.Path(source).resolve()
+        current = fingerprint(source)
+
+        with self.lock:
+            lock = self.locks.setdefault(source, threading.Lock())
+
+        with lock:
+            with self.lock:
+                entry = self.entries.get(source)
+
+            if entry is not None and entry[0] == current:
+                return entry[1]
+
+            if entry is not None:
+                shutil.rmtree(entry[1].parent, ignore_errors=True)
+
+            key = hashlib.sha1(f"{source}:{current}".encode()).hexdigest()
+            cached = self.path / key / source.name
+
+            # Remove what a failed copy may have left behind
+            shutil.rmtree(cached.parent, ignore_errors=True)
+            cached.parent.mkdir()
+
+            try:
+                if source.is_dir():
+                    parallelcopy.copytree(source, cached, workers=workers)
+                else:
+                    parallelcopy.copy2(source, cached)
+            except BaseException:
+                shutil.rmtree(cached.parent, ignore_errors=True)
+                raise
+
+            with self.lock:
+                self.entries[source] = (current, cached)
+
+            return cached
+
+    @staticmethod
+    def _fingerprint_file(path):
+        stat = os.stat(path)
+        return f"{stat.st_size}:{stat.st_mtime_ns}:{stat.st_mode}"
+
+    @staticmethod
+    def _fingerprint_dir(path):
+        fingerprint = hashlib.sha1()
+
+        # Follow symlinks the same way as shutil.copytree(...)
+        for root, dirs, files in os.walk(path, followlinks=True):
+            dirs.sort()
+
+            for name in sorted(dirs + files):
+                entry = os.path.join(root, name)
+                fingerprint.update(
+                    "{}:{}\n".format(
+                        os.path.relpath(entry, path),
+                        TemplateCache._fingerprint_file(entry),
+                    ).encode()
+                )
+
+        return fingerprint.hexdigest()
+
+    def _clone(self, source, destination):
+        """Create a reflink of the source file, the signature is compatible
+        with shutil.copy2 so it can be used with shutil.copytree."""
+        with open(source, "rb") as src, open(destination, "wb") as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+        shutil.copystat(source, destination)
+        return destination
+
+    def _probe_reflink(self):
+        """Check whether the file system of the cache supports reflinks."""
+        if fcntl is None:
+            return False
+
+        source = self.path / "reflink-probe"
+        destination = self.path / "reflink-probe-clone"
+
+        try:
+            source.write_bytes(b"probe")
+            self._clone(source, destination)
+        except OSError:
+            return False
+        finally:
+            for probe in (source, destination):
+                if probe.exists():
+                    probe.unlink()
+
+        return True
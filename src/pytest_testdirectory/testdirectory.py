@@ -6,19 +6,321 @@ import time
 import os
 import sys
 import pathlib
+import re
+import shlex
 import shutil
+import tempfile
+import concurrent.futures
+import contextlib
+import functools
+import asyncio
+import inspect
+import locale
+import signal
+import threading
 
 from . import runresult
 from . import runresulterror
+from . import runmanyerror
+from . import runtimeouterror
 from . import checkoutput
+from . import checkoutputfile
+from . import checkoutputbytes
+from . import checkoutputtruncated
+from . import outputreader
+from . import parallelcopy
+from . import snapshot
+from . import directoryindex
+from . import templatecache
+from . import resourceusage
+from . import usagereport
+from . import processlimit
+from . import pythonpool
+from . import environmentoverlay
+from . import syntheticfile
+from . import sealederror
+from . import trash
+from . import hashcache
+from . import treediff
+from . import treemismatcherror
+
+
+@pytest.fixture(scope="session")
+def testdirectory_templatecache(tmp_path_factory):
+    """Creates the session wide cache used when copying files and directories
+    into the test directories. See the TemplateCache class for more
+    information.
+    """
+    return templatecache.TemplateCache(path=tmp_path_factory.mktemp("templatecache"))
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup("testdirectory")
+    group.addoption(
+        "--testdirectory-durations",
+        type=int,
+        default=None,
+        metavar="N",
+        help="Show the time and resources used by the commands run in the "
+        "N slowest tests (N=0 for all).",
+    )
+    group.addoption(
+        "--testdirectory-report",
+        default=None,
+        metavar="PATH",
+        help="Write the time and resources used by each command run in each "
+        "test to a JSON file.",
+    )
+    group.addoption(
+        "--testdirectory-max-processes",
+        type=_parse_max_processes,
+        default=None,
+        metavar="N",
+        help="The maximum total weight of the commands run at the same time "
+        "across all pytest-xdist workers ('auto' for the number of CPUs).",
+    )
+    group.addoption(
+        "--testdirectory-timeout",
+        type=float,
+        default=None,
+        metavar="SECONDS",
+        help="The default timeout of the commands run in the test "
+        "directories, after which a command and the processes it started "
+        "are killed.",
+    )
+    group.addoption(
+        "--testdirectory-retention",
+        choices=("all", "failed", "none"),
+        default="all",
+        help="Which test directories to keep after the tests, the others "
+        "are deleted in the background (default: all).",
+    )
+    group.addoption(
+        "--testdirectory-retention-size",
+        type=_parse_size,
+        default=None,
+        metavar="SIZE",
+        help="The maximum total size of the test directories kept e.g. 10G, "
+        "the test directories after it is reached are deleted.",
+    )
+
+
+def _parse_max_processes(value):
+    if value == "auto":
+        return os.cpu_count() or 1
+
+    return int(value)
+
+
+def _parse_size(value):
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+    unit = units.get(value[-1:].upper())
+
+    if unit is None:
+        return int(value)
+
+    return int(float(value[:-1]) * unit)
+
+
+def pytest_configure(config):
+    durations = config.getoption("testdirectory_durations")
+    path = config.getoption("testdirectory_report")
+
+    if durations is not None or path is not None:
+        config.pluginmanager.register(
+            usagereport.UsageReport(
+                durations=durations,
+                path=path,
+                worker=hasattr(config, "workerinput"),
+            ),
+            "testdirectory-usagereport",
+        )
+
+
+@pytest.fixture(scope="session")
+def testdirectory_processlimit(tmp_path_factory, request):
+    """Creates the limit on the number of commands run at the same time by
+    the test directories, shared by all pytest-xdist workers. None unless
+    the --testdirectory-max-processes option is used. See the ProcessLimit
+    class for more information.
+    """
+    slots = request.config.getoption("testdirectory_max_processes")
+
+    if slots is None:
+        return None
+
+    basetemp = tmp_path_factory.getbasetemp()
+
+    # The base temporary directory of each pytest-xdist worker is inside the
+    # one of the session
+    if hasattr(request.config, "workerinput"):
+        basetemp = basetemp.parent
+
+    return processlimit.ProcessLimit(path=basetemp / "processlimit", slots=slots)
+
+
+@pytest.fixture(scope="session")
+def testdirectory_trash(tmp_path_factory, request):
+    """Creates the session wide trash used to remove directories in the
+    background, and which decides which test directories are kept after the
+    tests. See the Trash class for more information.
+    """
+    cleanup = trash.Trash(
+        path=tmp_path_factory.getbasetemp() / "testdirectory-trash",
+        retention=request.config.getoption("testdirectory_retention"),
+        max_size=request.config.getoption("testdirectory_retention_size"),
+    )
+    yield cleanup
+    cleanup.close()
+
+
+@pytest.fixture(scope="session")
+def testdirectory_hashcache(request):
+    """Creates the cache of the digests of the reference files compared by
+    TestDirectory.assert_matches_tree(...). It is stored in the pytest
+    cache directory, so unchanged reference trees are not hashed again in
+    the following sessions. See the HashCache class for more information.
+    """
+    cache = getattr(request.config, "cache", None)
+
+    if cache is None:
+        # The cacheprovider plugin is disabled
+        hashes = hashcache.HashCache()
+    else:
+        hashes = hashcache.HashCache(path=cache.mkdir("testdirectory") / "hashes.json")
+
+    yield hashes
+    hashes.save()
+
+
+@pytest.fixture(scope="session")
+def testdirectory_pythonpool():
+    """Creates the session wide pool of warm Python interpreters used by
+    TestDirectory.run_python(...). See the PythonPool class for more
+    information.
+    """
+    pool = pythonpool.PythonPool()
+    yield pool
+    pool.close()
 
 
 @pytest.fixture
-def testdirectory(tmpdir):
+def testdirectory(
+    tmpdir,
+    testdirectory_templatecache,
+    testdirectory_processlimit,
+    testdirectory_pythonpool,
+    testdirectory_trash,
+    testdirectory_hashcache,
+    request,
+):
     """Creates the py.test fixture to make it usable withing the unit tests.
     See the TestDirectory class for more information.
+
+    After the test the directory is kept or deleted in the background
+    depending on the --testdirectory-retention and
+    --testdirectory-retention-size options.
+    """
+    path = pathlib.Path(str(tmpdir))
+
+    yield _create_testdirectory(
+        path=path,
+        request=request,
+        templatecache=testdirectory_templatecache,
+        processlimit=testdirectory_processlimit,
+        pythonpool=testdirectory_pythonpool,
+        trash=testdirectory_trash,
+        hashcache=testdirectory_hashcache,
+    )
+
+    failed = getattr(request.node, "_testdirectory_failed", False)
+    testdirectory_trash.release(path, failed=failed)
+
+
+@pytest.fixture(scope="module")
+def module_testdirectory(
+    tmp_path_factory,
+    testdirectory_templatecache,
+    testdirectory_processlimit,
+    testdirectory_pythonpool,
+    testdirectory_trash,
+    testdirectory_hashcache,
+    request,
+):
+    """Creates a test directory shared by the tests in a module, e.g. for
+    expensive setup. The tests should work in a fork, see
+    TestDirectory.fork(...) and TestDirectory.seal(...).
+    """
+    return _create_testdirectory(
+        path=tmp_path_factory.mktemp(request.node.name),
+        request=request,
+        templatecache=testdirectory_templatecache,
+        processlimit=testdirectory_processlimit,
+        pythonpool=testdirectory_pythonpool,
+        trash=testdirectory_trash,
+        hashcache=testdirectory_hashcache,
+    )
+
+
+@pytest.fixture(scope="session")
+def session_testdirectory(
+    tmp_path_factory,
+    testdirectory_templatecache,
+    testdirectory_processlimit,
+    testdirectory_pythonpool,
+    testdirectory_trash,
+    testdirectory_hashcache,
+    request,
+):
+    """Creates a test directory shared by all the tests in the session,
+    e.g. for expensive setup. The tests should work in a fork, see
+    TestDirectory.fork(...) and TestDirectory.seal(...).
     """
-    return TestDirectory(tmpdir=pathlib.Path(str(tmpdir)))
+    return _create_testdirectory(
+        path=tmp_path_factory.mktemp("session"),
+        request=request,
+        templatecache=testdirectory_templatecache,
+        processlimit=testdirectory_processlimit,
+        pythonpool=testdirectory_pythonpool,
+        trash=testdirectory_trash,
+        hashcache=testdirectory_hashcache,
+    )
+
+
+def _create_testdirectory(
+    path, request, templatecache, processlimit, pythonpool, trash, hashcache
+):
+    testdirectory = TestDirectory(tmpdir=path, templatecache=templatecache)
+
+    testdirectory._shared.processlimit = processlimit
+    testdirectory._shared.pythonpool = pythonpool
+    testdirectory._shared.trash = trash
+    testdirectory._shared.hashcache = hashcache
+    testdirectory._shared.timeout = request.config.getoption("testdirectory_timeout")
+
+    report = request.config.pluginmanager.get_plugin("testdirectory-usagereport")
+    if report is not None:
+        testdirectory._shared.record = functools.partial(
+            report.record, request.node.nodeid
+        )
+
+    return testdirectory
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_makereport(item, call):
+    # Remember if the test failed, to decide if its test directory is kept
+    outcome = yield
+    if outcome.get_result().failed:
+        item._testdirectory_failed = True
+
+
+@pytest.hookimpl(trylast=True)
+def pytest_runtest_teardown(item):
+    # Check the sealed test directories used by the test
+    for value in getattr(item, "funcargs", {}).values():
+        if isinstance(value, TestDirectory) and value._seal is not None:
+            value.check_seal()
 
 
 class TestDirectory:
@@ -49,6 +351,10 @@ class TestDirectory:
     an initial set of files and finally run some executable and observe its
     behavior.
 
+    The environment variables of the commands are changed with the env
+    attribute, an EnvironmentOverlay. The TestDirectory objects created
+    with e.g. mkdir(...) or join(...) inherit the changes.
+
     Inspiration:
      - http://search.cpan.org/~sanbeg/Test-Directory-0.041/lib/Test/Directory.pm
      - pytest internal plugin for doing the same thing:
@@ -56,12 +362,22 @@ class TestDirectory:
 
     """
 
-    def __init__(self, tmpdir):
+    def __init__(self, tmpdir, templatecache=None):
         """Create a new TestDirectory instance.
 
         :param tmpdir: The temporary directory as a py.path.local instance or str.
+        :param templatecache: TemplateCache used when copying files and
+            directories or None to always copy directly from the source.
         """
         self.tmpdir = tmpdir
+        self.templatecache = templatecache
+        self.env = environmentoverlay.EnvironmentOverlay()
+
+        self._shared = _Shared()
+        self._use_index = False
+        self._index = None
+        self._index_generation = None
+        self._seal = None
 
     @staticmethod
     def from_path(path):
@@ -82,16 +398,24 @@ class TestDirectory:
         :param directory: The sub-directory to create as a string or pathlib.Path.
         """
         directory = pathlib.Path(directory)
+        self._changed()
 
         child_directory = self.tmpdir / directory
         child_directory.mkdir(parents=True, exist_ok=True)
 
-        return TestDirectory(tmpdir=child_directory)
+        return self._child(path=child_directory)
 
     def rmdir(self):
         """Remove the directory. If the directory is not empty, remove all
-        files and directories recursively."""
-        if self.tmpdir.exists():
+        files and directories recursively.
+
+        When used through the fixtures, the directory is renamed into the
+        trash and deleted in the background, see the Trash class."""
+        self._changed()
+
+        if self._shared.trash is not None and self.tmpdir.is_dir():
+            self._shared.trash.remove(self.tmpdir)
+        elif self.tmpdir.exists():
             shutil.rmtree(self.tmpdir)
 
         # @todo not sure if this is a good idea, but I guess the tmpdir is
@@ -106,7 +430,7 @@ class TestDirectory:
         if not new_path.exists():
             raise ValueError(f"{new_path} does not exist")
 
-        return TestDirectory(tmpdir=new_path)
+        return self._child(path=new_path)
 
     def rmfile(self, filename):
         """Remove a file.
@@ -114,6 +438,7 @@ class TestDirectory:
         :param filename: The name of the file to remove as a pathlib.Path or string.
         """
         file_path = self.tmpdir / pathlib.Path(filename)
+        self._changed()
 
         if file_path.is_file():
             file_path.unlink()
@@ -136,7 +461,14 @@ class TestDirectory:
         new_path = pathlib.Path(str(self.tmpdir)) / (
             rename_as if rename_as else file_path.name
         )
-        shutil.copy2(str(file_path), str(new_path))
+        self._changed()
+        self._unlink_overlay(new_path)
+
+        if self.templatecache is None:
+            parallelcopy.copy2(str(file_path), str(new_path))
+        else:
+            self.templatecache.copy_file(source=file_path, destination=new_path)
+
         return new_path
 
     def symlink_file(self, filename, rename_as="", relative=True):
@@ -161,6 +493,7 @@ class TestDirectory:
         if rename_as:
             link_name = self.tmpdir.joinpath(rename_as)
 
+        self._changed()
         self._create_symlink(str(filepath), str(link_name), isdir=False)
 
         return str(link_name)
@@ -192,27 +525,37 @@ class TestDirectory:
         if rename_as:
             link_name = self.tmpdir.joinpath(rename_as)
 
+        self._changed()
         self._create_symlink(source=directory, link_name=str(link_name), isdir=True)
 
         return str(link_name)
 
-    def copy_files(self, filename):
+    def copy_files(self, filename, workers=1):
         """Copy files into testdirectory. Expand filename by expanding wildcards
         e.g. ``dir/*``
 
         :param filename: The filename as a string or pathlib.Path. This
             represents a single file or glob pattern.
+        :param workers: The number of threads copying files. By default the
+            files are copied one at a time. If None the default of
+            concurrent.futures.ThreadPoolExecutor is used.
         """
 
         # Expand filename by expanding wildcards e.g. 'dir/*', the
         # glob returns a list of files
-        files = glob.glob(filename)
+        files = glob.glob(str(filename))
 
-        for file in files:
-            self.copy_file(filename=file)
+        if workers == 1:
+            for file in files:
+                self.copy_file(filename=file)
+            return
 
-    def copy_dir(self, directory):
-        """Copy a directory into the test directory.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(lambda file: self.copy_file(filename=file), files))
+
+    def copy_dir(self, directory, workers=1):
+        """Copy a directory into the test directory. The files can be copied
+        concurrently by a pool of threads, see workers.
 
         Example (using the test fixture test_directory)::
 
@@ -227,13 +570,86 @@ class TestDirectory:
                 print(app_dir.path())
 
         :param directory: Path to the directory as a string or pathlib.Path
+        :param workers: The number of threads copying files. By default the
+            files are copied one at a time. If None the default of
+            concurrent.futures.ThreadPoolExecutor is used.
         :return: TestDirectory object representing the copied directory
         """
         src_dir = pathlib.Path(directory)
         dst_dir = self.tmpdir / src_dir.name
-        shutil.copytree(src_dir, dst_dir)
+        self._changed()
+
+        if self.templatecache is None:
+            parallelcopy.copytree(src_dir, dst_dir, workers=workers)
+        else:
+            self.templatecache.copy_dir(
+                source=src_dir, destination=dst_dir, workers=workers
+            )
+
+        return self._child(path=dst_dir)
+
+    def overlay_dir(self, directory):
+        """Present a directory in the test directory without copying it.
+
+        The directories are created in the test directory while every file
+        is a symlink to the file in the source directory. This makes the
+        setup cost independent of the size of the files.
 
-        return TestDirectory(tmpdir=dst_dir)
+        Files are materialized i.e. replaced by a real copy when they are
+        written with write_text(...) or write_binary(...). Removing a file
+        with rmfile(...) only removes the symlink. Commands that modify
+        files in place would write to the source directory, so call
+        materialize(...) for those files first.
+
+        Example::
+
+            def test_something(testdirectory):
+                data = testdirectory.overlay_dir('/home/ok/data')
+                data.materialize('config.ini')
+
+                testdirectory.run('process --config=data/config.ini')
+
+        :param directory: Path to the directory as a string or pathlib.Path
+        :return: TestDirectory object representing the overlay directory
+        """
+        src_dir = pathlib.Path(directory).resolve()
+        dst_dir = self.tmpdir / src_dir.name
+        self._changed()
+        dst_dir.mkdir()
+
+        # Follow symlinks the same way as copy_dir(...)
+        for root, dirs, files in os.walk(src_dir, followlinks=True):
+            target = dst_dir / os.path.relpath(root, src_dir)
+
+            for name in dirs:
+                (target / name).mkdir()
+
+            for name in files:
+                self._create_symlink(
+                    source=os.path.join(root, name),
+                    link_name=str(target / name),
+                    isdir=False,
+                )
+
+        self._shared.overlays.append(dst_dir)
+
+        return self._child(path=dst_dir)
+
+    def materialize(self, filename):
+        """Replace a symlink created by overlay_dir(...) with a copy of the
+        file, such that it can be modified without changing the source.
+
+        :param filename: The name of the file as a string or pathlib.Path
+        :return: The path to the file as a pathlib.Path
+        """
+        file_path = self.tmpdir / pathlib.Path(filename)
+
+        if self._in_overlay(file_path):
+            source = file_path.resolve()
+            file_path.unlink()
+            parallelcopy.copy2(source, file_path)
+
+        return file_path
 
     def write_text(self, filename, data, encoding="utf-8"):
         """Writes a file in the temporary directory.
@@ -244,6 +660,8 @@ class TestDirectory:
         :return: The path to the file as a pathlib.Path
         """
         file_path = self.tmpdir / pathlib.Path(filename)
+        self._changed()
+        self._unlink_overlay(file_path)
         file_path.write_text(data, encoding=encoding)
         return file_path
 
@@ -255,9 +673,87 @@ class TestDirectory:
         :return: The path to the file as a pathlib.Path
         """
         file_path = self.tmpdir / pathlib.Path(filename)
+        self._changed()
+        self._unlink_overlay(file_path)
         file_path.write_bytes(data)
         return file_path
 
+    def populate(self, spec, workers=1):
+        """Create a tree of directories and files in the test directory.
+
+        The directories are created in one pass before the files are
+        written. Example::
+
+            def test_something(testdirectory):
+                testdirectory.populate({
+                    "config.ini": "[main]\\nverbose = 1\\n",
+                    "data": {
+                        "image.png": b"\\x89PNG...",
+                        "huge.bin": SyntheticFile(size=1024**3),
+                        "empty": {},
+                    },
+                })
+
+        :param spec: Dict mapping names to the content of files or to
+            dicts describing directories, or an iterable of (path, content)
+            pairs. The content of a file is a string (written as UTF-8),
+            bytes or a SyntheticFile. The paths are relative to the test
+            directory and use / as separator.
+        :param workers: The number of threads writing files. If None the
+            default of concurrent.futures.ThreadPoolExecutor is used.
+        :return: List of the paths to the files as pathlib.Path objects
+        """
+        directories = set()
+        files = []
+
+        for path, content in self._flatten(spec):
+            path = self.tmpdir / path
+
+            if isinstance(content, dict):
+                directories.add(path)
+            else:
+                files.append((path, content))
+
+        directories.update(path.parent for path, _ in files)
+        self._changed()
+
+        # Sorted, every directory comes after its parent
+        for directory in sorted(directories):
+            if directory != self.tmpdir:
+                directory.mkdir(parents=True, exist_ok=True)
+
+        def write(item):
+            path, content = item
+
+            if self._shared.overlays:
+                self._unlink_overlay(path)
+
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+
+            try:
+                if isinstance(content, syntheticfile.SyntheticFile):
+                    content.write(fd)
+                    return
+
+                if isinstance(content, str):
+                    content = content.encode("utf-8")
+
+                view = memoryview(content)
+
+                while view:
+                    view = view[os.write(fd, view) :]
+            finally:
+                os.close(fd)
+
+        if workers == 1:
+            for item in files:
+                write(item)
+        else:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+                list(pool.map(write, files))
+
+        return [path for path, _ in files]
+
     def contains_file(self, filename):
         """Checks for the existence of a file.
 
@@ -266,7 +762,11 @@ class TestDirectory:
         :return: True if the file is contained within the test directory.
         :raises: ValueError if there is more than one match.
         """
-        matches = list(self.tmpdir.glob(filename))
+        matches = self._indexed_glob(pattern=filename, hidden=True)
+
+        if matches is None:
+            matches = list(self.tmpdir.glob(filename))
+
         if len(matches) == 1 and matches[0].is_file():
             return True
         elif len(matches) > 1:
@@ -283,7 +783,19 @@ class TestDirectory:
 
         # Expand filename by expanding wildcards e.g. 'dir/*/file.txt', the
         # glob should return only one file
-        directories = glob.glob(os.path.join(self.path(), *directories))
+        # Without directories the test directory itself is checked, which
+        # the index does not contain
+        matches = None
+
+        if directories:
+            matches = self._indexed_glob(
+                pattern=os.path.join(*directories), hidden=False
+            )
+
+        if matches is None:
+            directories = glob.glob(os.path.join(self.path(), *directories))
+        else:
+            directories = [str(match) for match in matches]
 
         if len(directories) != 1:
             return False
@@ -294,82 +806,746 @@ class TestDirectory:
 
         return True
 
-    def run(self, args, **kwargs):
+    def run(
+        self,
+        args,
+        capture="memory",
+        until=None,
+        timeout=None,
+        snapshot=False,
+        weight=1,
+        head=None,
+        tail=None,
+        compress=False,
+        **kwargs,
+    ):
         """Runs the command in the test directory.
 
+        The output of the command is captured according to the capture
+        argument:
+
+        - ``"memory"``: The output is kept in memory and stored in a
+          CheckOutput object.
+        - ``"file"``: The output is spooled to files in the test directory
+          and stored in a CheckOutputFile object. This keeps the memory
+          footprint bounded no matter how much output the command
+          generates.
+        - ``"bytes"``: The output is kept in memory without decoding it and
+          stored in a CheckOutputBytes object, e.g. for binary output.
+        - ``"discard"``: The output is not captured, the stdout and stderr
+          of the RunResult are None.
+
+        To keep the memory footprint bounded while capturing in memory, head
+        and tail limit the output to the first and last lines. The lines in
+        between are omitted, and only counted, and the output is stored in
+        a CheckOutputTruncated object::
+
+            r = testdirectory.run("build --verbose", tail=100)
+
+        Tests which keep many results can store the output captured in
+        memory compressed with compress=True, it is decompressed each time
+        it is accessed.
+
+        A list of arguments is run directly without a shell. A string is
+        run by the shell if it uses features of the shell e.g. variables,
+        wildcards, redirections, pipes or builtins, otherwise it is split
+        into arguments and run directly, which saves starting the shell.
+        Pass shell=True or shell=False to choose explicitly. With shell=True
+        a list is joined with spaces, without quoting, as before::
+
+            r = testdirectory.run(["echo", "$HOME"])  # Prints $HOME
+            r = testdirectory.run("echo $HOME")  # Prints the home directory
+            r = testdirectory.run(["echo", "$HOME"], shell=True)  # Also
+
+        If until is specified the output is watched while the command runs.
+        As soon as a line matches one of the patterns the command and any
+        processes it started are killed and the result is returned::
+
+            r = testdirectory.run("server", until="*listening on*", timeout=10)
+
+        If the command, or a process it started which holds on to its
+        output, is still running after the timeout, they are all killed
+        and a RunTimeoutError with the output collected until then is
+        raised. The default timeout can be set for the whole session with
+        the --testdirectory-timeout option.
+
         :param args: String or list of arguments
+        :param capture: How to capture the stdout and stderr of the command
+            as a string, either "memory", "file", "bytes" or "discard".
+        :param until: Pattern or list of patterns to wait for in the
+            stdout or stderr of the command, see CheckOutput.match(...).
+        :param timeout: The maximum time in seconds the command may run, or
+            to wait for one of the until patterns. If None the timeout of
+            the --testdirectory-timeout option is used, if any.
+        :param snapshot: If True the test directory is snapshotted before and
+            after running the command and the differences are stored in the
+            diff attribute of the RunResult.
+        :param weight: The number of slots the command takes while it runs
+            when the number of commands running at the same time is limited
+            with the --testdirectory-max-processes option, e.g. the number
+            of threads it uses. See ProcessLimit.
+        :param head: The number of lines to keep from the beginning of the
+            output or None
+        :param tail: The number of lines to keep from the end of the output
+            or None
+        :param compress: If True the output captured in memory is stored
+            compressed, see CheckOutput.
         :param kwargs: Keyword arguments passed to Popen(...)
 
         :return: A RunResult object representing the result of the command
+        :raises: RunResultError if the command failed or exited without
+            printing one of the until patterns.
+        :raises: RunTimeoutError if the command did not exit, or none of
+            the until patterns were found, within the timeout.
         """
 
-        if "shell" not in kwargs:
-            kwargs["shell"] = True
+        if capture not in ("memory", "file", "bytes", "discard"):
+            raise ValueError(f"Unknown capture {capture!r}")
+
+        if (head is not None or tail is not None) and capture != "memory":
+            raise ValueError("The head and tail require capture='memory'")
+
+        if compress and capture != "memory":
+            raise ValueError("The compress requires capture='memory'")
+
+        if isinstance(until, str):
+            until = [until]
+
+        if timeout is None:
+            timeout = self._shared.timeout
+
+        command = self._command_string(args, shell=kwargs.get("shell", False))
+        args = self._prepare_run(args=args, kwargs=kwargs)
+
+        spool = {}
+
+        for stream in ("stdout", "stderr"):
+            if stream in kwargs:
+                continue
+
+            if capture == "discard":
+                kwargs[stream] = subprocess.DEVNULL
+                continue
+
+            if capture == "file":
+                spool[stream] = tempfile.NamedTemporaryFile(
+                    dir=str(self.tmpdir),
+                    prefix=f"{stream}-",
+                    suffix=".txt",
+                    delete=False,
+                )
+
+            if capture == "file" and until is None:
+                kwargs[stream] = spool[stream]
+            else:
+                kwargs[stream] = subprocess.PIPE
+
+        if until is not None:
+            if (
+                kwargs["stdout"] != subprocess.PIPE
+                and kwargs["stderr"] != subprocess.PIPE
+            ):
+                raise ValueError("The until patterns require stdout or stderr")
+
+        if (until is not None or timeout is not None) and sys.platform != "win32":
+            # Run the command in a new process group, so we can kill it
+            # including the processes it starts
+            kwargs.setdefault("start_new_session", True)
+
+        if snapshot:
+            # The output files are not created by the command
+            spool_paths = [spool_file.name for spool_file in spool.values()]
+            before = self.snapshot(exclude=spool_paths)
+
+        # Wait for a free slot before the command is timed
+        with self._acquire(weight=weight):
+            start_time = time.perf_counter()
+            deadline = None if timeout is None else start_time + timeout
+
+            try:
+                popen = subprocess.Popen(
+                    args,
+                    # The OutputReader reads the pipes as bytes and decodes
+                    # the output itself, text mode only applies to the
+                    # Popen file objects
+                    universal_newlines=True,
+                    **kwargs,
+                )
+            finally:
+                # The child process has its own handles to the spool files
+                for spool_file in spool.values():
+                    spool_file.close()
+
+            # The output is read by threads rather than Popen.communicate(...),
+            # which waits for the command without collecting its resource usage
+            condition = threading.Condition()
+            regex = checkoutput._compile(until) if until is not None else None
+            readers = []
+
+            for stream in ("stdout", "stderr"):
+                if getattr(popen, stream) is None:
+                    readers.append(None)
+                    continue
+
+                readers.append(
+                    outputreader.OutputReader(
+                        stream=getattr(popen, stream),
+                        condition=condition,
+                        regex=regex,
+                        path=spool[stream].name if stream in spool else None,
+                        encoding=kwargs.get("encoding"),
+                        errors=kwargs.get("errors"),
+                        head=head,
+                        tail=tail,
+                    )
+                )
+
+            active = [reader for reader in readers if reader is not None]
+
+            matched = False
+            timed_out = False
+            resources = None
+
+            if until is not None:
+                with condition:
+                    finished = condition.wait_for(
+                        lambda: any(r.matched for r in active)
+                        or all(r.closed for r in active),
+                        timeout=self._remaining(deadline),
+                    )
+
+                matched = any(reader.matched for reader in active)
+                timed_out = not finished
+
+            if not matched and not timed_out:
+                # The output is closed, but the command may still be running
+                try:
+                    resources = self._wait(
+                        popen=popen, timeout=self._remaining(deadline)
+                    )
+                except subprocess.TimeoutExpired:
+                    timed_out = True
+
+            if until is None and not timed_out and deadline is not None:
+                # The command exited, but a process it started may still hold
+                # the pipes
+                for reader in active:
+                    reader.join(timeout=self._remaining(deadline))
+
+                timed_out = not all(reader.closed for reader in active)
+
+            if matched or timed_out:
+                self._kill_process_tree(
+                    popen=popen, session=kwargs.get("start_new_session", False)
+                )
+
+                if popen.returncode is None:
+                    resources = self._wait(popen=popen)
+
+            for reader in active:
+                if until is None and deadline is None:
+                    reader.join()
+                else:
+                    # A process outside the process group may still hold the pipe
+                    reader.join(timeout=1)
+
+        end_time = time.perf_counter()
+        self._changed()
+
+        diff = None
+        if snapshot:
+            diff = self.diff(before=before, after=self.snapshot(exclude=spool_paths))
 
-            # The rules for how subprocess handles arguments is a bit complex we
-            # typically would like to have environment variable expansion etc.
-            # so we would run commands via the shell - this seems to imply that
-            # the command should be passed as a string.
-            if isinstance(args, list):
-                args = " ".join(args)
+        # The stdout and stderr are wrapped in a CheckOutput object to make
+        # it easy to assert whether it contains specific data / strings.
+        stdout, stderr = [
+            self._check_output(
+                capture=capture,
+                reader=reader,
+                path=spool[stream].name if stream in spool else None,
+                compress=compress,
+                encoding=kwargs.get("encoding"),
+                errors=kwargs.get("errors"),
+            )
+            for stream, reader in zip(("stdout", "stderr"), readers)
+        ]
 
-        if "env" not in kwargs:
-            # If 'env' is not passed as keyword argument use a copy of the
-            # current environment.
-            kwargs["env"] = os.environ.copy()
+        result = runresult.RunResult(
+            command=command,
+            path=self.path(),
+            stdout=stdout,
+            stderr=stderr,
+            returncode=popen.returncode,
+            time=end_time - start_time,
+            diff=diff,
+            resources=resources,
+        )
 
-        if "stdout" not in kwargs:
-            kwargs["stdout"] = subprocess.PIPE
+        self._record(result)
 
-        if "stderr" not in kwargs:
-            kwargs["stderr"] = subprocess.PIPE
+        if timed_out:
+            raise runtimeouterror.RunTimeoutError(runresult=result, timeout=timeout)
 
-        if "cwd" not in kwargs:
-            # Sets the current working directory to the path of
-            # the tmpdir
-            kwargs["cwd"] = str(self.tmpdir)
+        if until is not None and not matched:
+            raise runresulterror.RunResultError(result)
+
+        if until is None and popen.returncode != 0:
+            raise runresulterror.RunResultError(result)
+
+        return result
+
+    def run_many(self, commands, workers=None, **kwargs):
+        """Runs a number of commands concurrently in the test directory.
+
+        Example::
+
+            def test_formats(testdirectory):
+                results = testdirectory.run_many(
+                    [f"imagecompress --format={f}" for f in ["png", "jpg"]],
+                    workers=2,
+                )
+
+        :param commands: List of commands, each a string or list of arguments
+            as accepted by run(...)
+        :param workers: The maximum number of commands running at the same
+            time. If None the default of concurrent.futures.ThreadPoolExecutor
+            is used.
+        :param kwargs: Keyword arguments passed to run(...) for every command
+
+        :return: A list of RunResult objects in the order the commands were
+            given
+        :raises: RunManyError if one or more of the commands failed
+        """
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(self.run, command, **kwargs) for command in commands]
+
+        runresults = []
+        errors = []
+
+        for future in futures:
+            try:
+                runresults.append(future.result())
+            except runresulterror.RunResultError as error:
+                runresults.append(error.runresult)
+                errors.append(error)
+
+        if errors:
+            raise runmanyerror.RunManyError(errors=errors, runresults=runresults)
+
+        return runresults
+
+    def run_python(
+        self,
+        target,
+        args=(),
+        capture="memory",
+        timeout=None,
+        weight=1,
+        env=None,
+        compress=False,
+    ):
+        """Runs a Python module or entry point in the test directory.
+
+        The interpreter is forked from a warm process which has already
+        started and imported the modules of the target, which saves the
+        startup time of a new interpreter for each run. Each run starts
+        from the same clean state. See the PythonPool class for more
+        information.
+
+        Where the pool is not supported, or the TestDirectory was not
+        created by the fixture, a new interpreter is started with run(...).
+
+        Example::
+
+            def test_cli(testdirectory):
+                r = testdirectory.run_python("mytool.cli:main", ["--help"])
+                assert r.stdout.match("usage: *")
+
+        :param target: The module to run like python -m, e.g. "pkg.cli", or
+            an entry point, e.g. "pkg.cli:main"
+        :param args: String or list of arguments
+        :param capture: How to capture the stdout and stderr, see run(...)
+        :param timeout: The maximum time in seconds the target may run. If
+            None the timeout of the --testdirectory-timeout option is used,
+            if any.
+        :param weight: The number of slots the run takes, see run(...)
+        :param env: Dict of environment variables or None to use the
+            environment of the env overlay
+        :param compress: If True the output captured in memory is stored
+            compressed, see run(...)
+
+        :return: A RunResult object representing the result of the run
+        :raises: RunResultError if the target failed
+        :raises: RunTimeoutError if the target did not exit within the
+            timeout
+        """
+
+        if capture not in ("memory", "file", "bytes"):
+            raise ValueError(f"Unknown capture {capture!r}")
+
+        if compress and capture != "memory":
+            raise ValueError("The compress requires capture='memory'")
+
+        if isinstance(args, str):
+            args = shlex.split(args)
+
+        args = list(args)
+        pool = self._shared.pythonpool
+
+        if timeout is None:
+            timeout = self._shared.timeout
 
-        start_time = time.time()
+        if pool is None or not pool.supported:
+            kwargs = {} if env is None else {"env": env}
 
-        popen = subprocess.Popen(
-            args,
-            # Need to decode the stdout and stderr with the correct
-            # character encoding (http://stackoverflow.com/a/28996987)
-            universal_newlines=True,
-            **kwargs,
+            return self.run(
+                [sys.executable] + self._python_args(target) + args,
+                shell=False,
+                capture=capture,
+                timeout=timeout,
+                weight=weight,
+                compress=compress,
+                **kwargs,
+            )
+
+        spool = {}
+
+        for stream in ("stdout", "stderr"):
+            with tempfile.NamedTemporaryFile(
+                dir=str(self.tmpdir),
+                prefix=f"{stream}-",
+                suffix=".txt",
+                delete=False,
+            ) as spool_file:
+                spool[stream] = pathlib.Path(spool_file.name)
+
+        with self._acquire(weight=weight):
+            start_time = time.perf_counter()
+
+            try:
+                returncode, resources, timed_out = pool.run(
+                    target=target,
+                    args=args,
+                    cwd=self.tmpdir,
+                    env=env or self.env.environ() or os.environ,
+                    stdout=spool["stdout"],
+                    stderr=spool["stderr"],
+                    timeout=timeout,
+                )
+            except BaseException:
+                for path in spool.values():
+                    path.unlink()
+                raise
+
+            end_time = time.perf_counter()
+
+        self._changed()
+
+        if capture == "file":
+            stdout = checkoutputfile.CheckOutputFile(path=spool["stdout"])
+            stderr = checkoutputfile.CheckOutputFile(path=spool["stderr"])
+        elif capture == "bytes":
+            stdout = checkoutputbytes.CheckOutputBytes(
+                output=spool["stdout"].read_bytes()
+            )
+            stderr = checkoutputbytes.CheckOutputBytes(
+                output=spool["stderr"].read_bytes()
+            )
+
+            for path in spool.values():
+                path.unlink()
+        else:
+            encoding = locale.getpreferredencoding(False)
+            stdout = checkoutput.CheckOutput(
+                output=spool["stdout"].read_bytes().decode(encoding),
+                compress=compress,
+            )
+            stderr = checkoutput.CheckOutput(
+                output=spool["stderr"].read_bytes().decode(encoding),
+                compress=compress,
+            )
+
+            for path in spool.values():
+                path.unlink()
+
+        result = runresult.RunResult(
+            command=self._command_string(
+                (["python", "-m", target] if ":" not in target else [target]) + args
+            ),
+            path=self.path(),
+            stdout=stdout,
+            stderr=stderr,
+            returncode=returncode,
+            time=end_time - start_time,
+            resources=resources,
         )
 
-        stdout, stderr = popen.communicate()
+        self._record(result)
 
-        end_time = time.time()
+        if timed_out:
+            raise runtimeouterror.RunTimeoutError(runresult=result, timeout=timeout)
 
-        # The stdout and stderr are wrapped in a CheckOutput object to make
-        # it easy to assert whether it contains specific data / strings.
+        if returncode != 0:
+            raise runresulterror.RunResultError(result)
+
+        return result
 
-        if stdout is not None:
-            stdout = checkoutput.CheckOutput(output=stdout)
+    async def arun(self, args, on_stdout=None, on_stderr=None, timeout=None, **kwargs):
+        """Runs the command in the test directory using asyncio.
 
-        if stderr is not None:
-            stderr = checkoutput.CheckOutput(output=stderr)
+        The lines written to stdout and stderr can be observed while the
+        command is running by passing a callback. The callback is invoked
+        with each line (without the line ending) as a string and may be a
+        coroutine function.
+
+        Example::
+
+            def test_server(testdirectory):
+
+                async def main():
+                    ready = asyncio.Event()
+
+                    def on_stdout(line):
+                        if fnmatch.fnmatch(line, "*server ready*"):
+                            ready.set()
+
+                    server = asyncio.create_task(
+                        testdirectory.arun("server", on_stdout=on_stdout))
+
+                    await ready.wait()
+                    ...
+
+                asyncio.run(main())
+
+        :param args: String or list of arguments
+        :param on_stdout: Callback invoked with each line written to stdout
+        :param on_stderr: Callback invoked with each line written to stderr
+        :param timeout: The maximum time in seconds the command may run,
+            see run(...)
+        :param kwargs: Keyword arguments passed to
+            asyncio.create_subprocess_shell(...) or
+            asyncio.create_subprocess_exec(...)
+
+        :return: A RunResult object representing the result of the command
+        :raises: RunResultError if the command failed
+        :raises: RunTimeoutError if the command did not exit within the
+            timeout
+        """
+
+        command = self._command_string(args, shell=kwargs.get("shell", False))
+        args = self._prepare_run(args=args, kwargs=kwargs)
+
+        for stream in ("stdout", "stderr"):
+            kwargs.setdefault(stream, asyncio.subprocess.PIPE)
+
+        # Allow long lines, asyncio's default limit is 64 KiB
+        kwargs.setdefault("limit", 16 * 1024 * 1024)
+
+        if timeout is None:
+            timeout = self._shared.timeout
+
+        if timeout is not None and sys.platform != "win32":
+            kwargs.setdefault("start_new_session", True)
+
+        start_time = time.perf_counter()
+
+        if kwargs.pop("shell"):
+            process = await asyncio.create_subprocess_shell(args, **kwargs)
+        elif isinstance(args, list):
+            process = await asyncio.create_subprocess_exec(*args, **kwargs)
+        else:
+            process = await asyncio.create_subprocess_exec(args, **kwargs)
 
-        command = args
-        if isinstance(command, list):
-            command = " ".join(command)
+        # The lines are collected as they are read, so they are kept if the
+        # command times out
+        lines = ([], [])
+
+        async def communicate():
+            await asyncio.gather(
+                self._read_lines(process.stdout, on_stdout, lines[0]),
+                self._read_lines(process.stderr, on_stderr, lines[1]),
+            )
+            return await process.wait()
+
+        timed_out = False
+
+        try:
+            returncode = await asyncio.wait_for(communicate(), timeout=timeout)
+        except asyncio.TimeoutError:
+            timed_out = True
+            self._kill_process_tree(
+                popen=process, session=kwargs.get("start_new_session", False)
+            )
+            returncode = await process.wait()
+
+        end_time = time.perf_counter()
+        self._changed()
+
+        stdout, stderr = [
+            None if stream is None else checkoutput.CheckOutput(output="\n".join(read))
+            for stream, read in zip((process.stdout, process.stderr), lines)
+        ]
 
         result = runresult.RunResult(
             command=command,
             path=self.path(),
             stdout=stdout,
             stderr=stderr,
-            returncode=popen.returncode,
+            returncode=returncode,
             time=end_time - start_time,
         )
 
-        if popen.returncode != 0:
+        self._record(result)
+
+        if timed_out:
+            raise runtimeouterror.RunTimeoutError(runresult=result, timeout=timeout)
+
+        if returncode != 0:
             raise runresulterror.RunResultError(result)
 
         return result
 
+    def enable_index(self):
+        """Answer contains_file(...) and contains_dir(...) from an in memory
+        index of the test directory instead of searching the file system on
+        every call. The index is built from a single walk of the tree.
+
+        The index is rebuilt when needed after the files or directories
+        were changed by the methods of this class, including run(...).
+        Call refresh() after changing them in other ways.
+        """
+        self._use_index = True
+
+    def refresh(self):
+        """Rebuild the index on the next lookup, see enable_index()."""
+        self._changed()
+
+    def snapshot(self, hash=False, exclude=()):
+        """Take a snapshot of the files and directories in the test directory.
+
+        Example::
+
+            def test_something(testdirectory):
+                before = testdirectory.snapshot()
+                testdirectory.run('imagecompress --path=images')
+
+                diff = testdirectory.diff(before)
+                assert diff.added == ['images/image.jpg.gz']
+
+        :param hash: If True the content of the files is hashed, such that
+            modifications which keep the size and modification time are
+            detected.
+        :param exclude: Paths to leave out of the snapshot
+        :return: A Snapshot object
+        """
+        return snapshot.Snapshot.create(path=self.tmpdir, hash=hash, exclude=exclude)
+
+    def diff(self, before, after=None):
+        """Compare two snapshots of the test directory.
+
+        :param before: The earlier Snapshot
+        :param after: The later Snapshot, if None a new snapshot is taken
+        :return: A SnapshotDiff object with the added, removed and modified
+            paths
+        """
+        if after is None:
+            after = self.snapshot(hash=before.hash)
+
+        return before.diff(after)
+
+    def assert_matches_tree(self, reference, workers=None):
+        """Assert that the test directory has the same files and directories
+        with the same content as a reference tree, e.g. of expected output.
+
+        Example::
+
+            def test_generate(testdirectory):
+                testdirectory.run("generate --output=out")
+                testdirectory.join("out").assert_matches_tree("test/golden")
+
+        The sizes are compared first and only the files with the same size
+        are hashed, in parallel. A textual diff is only computed for the
+        files which differ. When used through the fixtures, the digests of
+        the reference files are cached between sessions, see HashCache.
+
+        :param reference: The reference tree as a string or pathlib.Path
+        :param workers: The number of threads hashing files, see
+            TreeDiff.compare(...)
+        :raises: TreeMismatchError, an AssertionError, listing the missing,
+            unexpected and differing paths
+        """
+        diff = treediff.TreeDiff.compare(
+            path=self.tmpdir,
+            reference=reference,
+            hashcache=self._shared.hashcache,
+            workers=workers,
+        )
+
+        if diff:
+            raise treemismatcherror.TreeMismatchError(
+                path=self.tmpdir, reference=reference, diff=diff
+            )
+
+    def fork(self, destination, overlay=False):
+        """Give a test its own copy of a shared, prepared test directory.
+
+        Expensive setup can be done once in e.g. the session_testdirectory
+        fixture, and each test works in a fork of it::
+
+            @pytest.fixture(scope="session")
+            def toolchain(session_testdirectory):
+                session_testdirectory.run("build-toolchain")
+                session_testdirectory.seal()
+                return session_testdirectory
+
+            def test_compile(toolchain, testdirectory):
+                work = toolchain.fork(testdirectory)
+                work.run("compile main.c")
+
+        The fork is a copy made with copy_dir(...), so the files are
+        reflinks of a cached copy where the file system supports it, or an
+        overlay made with overlay_dir(...) where every file is a symlink.
+
+        :param destination: The TestDirectory to create the fork in
+        :param overlay: If True the fork is an overlay, which is cheaper to
+            create, but files modified in place change the shared directory
+        :return: TestDirectory object representing the fork
+        """
+        if overlay:
+            return destination.overlay_dir(self.tmpdir)
+
+        return destination.copy_dir(self.tmpdir)
+
+    def seal(self, hash=False):
+        """Record the content of the test directory, such that changes to it
+        are detected by check_seal(...).
+
+        When the test directory is used by a test, e.g. through the
+        session_testdirectory or module_testdirectory fixtures, the seal is
+        checked after the test and a SealedError is reported as an error
+        in the teardown of the test that changed it.
+
+        :param hash: If True the content of the files is hashed, see
+            snapshot(...). Otherwise only the size, modification time and
+            inode of the files are compared.
+        """
+        self._seal = self.snapshot(hash=hash)
+
+    def check_seal(self):
+        """Check that the test directory did not change since seal(...) was
+        called. If it did the directory is sealed again as it is, so the
+        change is only reported once.
+
+        :raises: SealedError if a file or directory was added, removed or
+            modified
+        """
+        diff = self.diff(before=self._seal)
+
+        if diff:
+            self.seal(hash=self._seal.hash)
+            raise sealederror.SealedError(path=self.tmpdir, diff=diff)
+
     def __str__(self):
         """Generate a single string representation of the testdirectory.
 
@@ -378,6 +1554,358 @@ class TestDirectory:
         """
         return str(self.tmpdir)
 
+    def _child(self, path):
+        """Create a TestDirectory instance for a path inside this test
+        directory sharing the same configuration.
+
+        :param path: The path as a pathlib.Path
+        """
+        child = TestDirectory(tmpdir=path, templatecache=self.templatecache)
+        child._shared = self._shared
+        child.env = environmentoverlay.EnvironmentOverlay(parent=self.env)
+        child._use_index = self._use_index
+        return child
+
+    def _changed(self):
+        """Invalidate the indexes of this and the related TestDirectory
+        instances as the files or directories are about to change."""
+        self._shared.generation += 1
+
+    def _indexed_glob(self, pattern, hidden):
+        """Find the paths matching a glob pattern using the index.
+
+        :return: List of the matching paths as pathlib.Path objects or None
+            if the index is disabled or cannot answer the pattern.
+        """
+        if not self._use_index:
+            return None
+
+        if self._index is None or self._index_generation != self._shared.generation:
+            self._index = directoryindex.DirectoryIndex(path=self.tmpdir)
+            self._index_generation = self._shared.generation
+
+        matches = self._index.glob(pattern=pattern, hidden=hidden)
+
+        if matches is None:
+            return None
+
+        return [self.tmpdir / match for match in matches]
+
+    def _in_overlay(self, path):
+        """:return: True if path is a symlink created by overlay_dir(...)"""
+        if not path.is_symlink():
+            return False
+
+        return any(overlay in path.parents for overlay in self._shared.overlays)
+
+    def _unlink_overlay(self, path):
+        """Remove a symlink created by overlay_dir(...), such that the file
+        is not written through the symlink."""
+        if self._in_overlay(path):
+            path.unlink()
+
+    def _prepare_run(self, args, kwargs):
+        """Set the default keyword arguments for running a command.
+
+        :param args: String or list of arguments
+        :param kwargs: Dict of keyword arguments, updated in place
+        :return: The arguments to run
+        """
+
+        if "env" not in kwargs:
+            # If 'env' is not passed as keyword argument use the environment
+            # of the overlay, None inherits the current environment.
+            kwargs["env"] = self.env.environ()
+
+        if "cwd" not in kwargs:
+            # Sets the current working directory to the path of
+            # the tmpdir
+            kwargs["cwd"] = str(self.tmpdir)
+
+        if "shell" not in kwargs:
+            # Running the command directly saves starting a shell, which is
+            # only needed if the command uses its features
+            kwargs["shell"] = isinstance(args, str) and self._needs_shell(
+                command=args, kwargs=kwargs
+            )
+
+            if isinstance(args, str) and not kwargs["shell"]:
+                args = shlex.split(args)
+
+        elif kwargs["shell"] and isinstance(args, list):
+            args = self._command_string(args, shell=True)
+
+        return args
+
+    @staticmethod
+    def _needs_shell(command, kwargs):
+        """Check whether a command string must be run by the shell.
+
+        :param command: The command as a string
+        :param kwargs: Dict of keyword arguments passed to Popen(...)
+        :return: True if the command uses features of the shell e.g.
+            expansions, redirections or builtins
+        """
+        if sys.platform == "win32":
+            # The rules for splitting the command line differ from program
+            # to program on Windows
+            return True
+
+        if _SHELL_CHARACTERS.search(command):
+            return True
+
+        try:
+            words = shlex.split(command)
+        except ValueError:
+            # E.g. an unterminated quote, let the shell report it
+            return True
+
+        if not words or "=" in words[0]:
+            # Nothing to run or a variable assignment
+            return True
+
+        if os.path.dirname(words[0]):
+            # Relative paths are resolved in the working directory
+            program = os.path.join(kwargs.get("cwd", ""), words[0])
+            return not os.access(program, os.X_OK)
+
+        # Builtins and functions of the shell are not on the PATH
+        path = (kwargs.get("env") or os.environ).get("PATH", os.defpath)
+        return shutil.which(words[0], path=path) is None
+
+    @staticmethod
+    def _command_string(args, shell=False):
+        """The command as a string e.g. for RunResult.command.
+
+        :param args: String or list of arguments
+        :param shell: True if the command is run by the shell, then a list
+            of arguments is joined without quoting, so the shell expands
+            them
+        :return: The command as a string, a list of arguments is quoted
+            the way the shell would need it
+        """
+        if isinstance(args, str):
+            return args
+
+        args = [str(arg) for arg in args]
+
+        if shell:
+            return " ".join(args)
+
+        if sys.platform == "win32":
+            return subprocess.list2cmdline(args)
+
+        # Same as shlex.join(...), which requires Python 3.8
+        return " ".join(shlex.quote(arg) for arg in args)
+
+    @staticmethod
+    async def _read_lines(stream, callback, lines):
+        """Read the lines from an asyncio stream until it is closed.
+
+        :param stream: The asyncio.StreamReader to read or None
+        :param callback: Function or coroutine function invoked with each
+            line, may be None
+        :param lines: List the lines read are appended to
+        """
+        if stream is None:
+            return
+
+        # Decode the same way as Popen(..., universal_newlines=True)
+        encoding = locale.getpreferredencoding(False)
+
+        while True:
+            line = await stream.readline()
+            if not line:
+                break
+
+            line = line.decode(encoding).rstrip("\r\n")
+            lines.append(line)
+
+            if callback is not None:
+                result = callback(line)
+                if inspect.isawaitable(result):
+                    await result
+
+    @staticmethod
+    def _check_output(
+        capture, reader, path, compress=False, encoding=None, errors=None
+    ):
+        """Wrap the output of a stream of a command.
+
+        :param capture: How the output was captured, see run(...)
+        :param reader: The OutputReader of the stream or None
+        :param path: The file the output was spooled to or None
+        :param compress: If True the output is stored compressed
+        :param encoding: The encoding of output spooled to a file or None
+        :param errors: How decoding errors of output spooled to a file are
+            handled or None
+        :return: A CheckOutput object or None if the stream was not captured
+        """
+        if path is not None:
+            return checkoutputfile.CheckOutputFile(
+                path=path, encoding=encoding, errors=errors
+            )
+
+        if reader is None:
+            return None
+
+        if capture == "bytes":
+            return checkoutputbytes.CheckOutputBytes(output=reader.data())
+
+        if reader.sink is None:
+            head, tail, omitted_lines, omitted_bytes = reader.truncated()
+
+            return checkoutputtruncated.CheckOutputTruncated(
+                head=head,
+                tail=tail,
+                omitted_lines=omitted_lines,
+                omitted_bytes=omitted_bytes,
+            )
+
+        return checkoutput.CheckOutput(output=reader.output(), compress=compress)
+
+    @staticmethod
+    def _python_args(target):
+        """The interpreter arguments running a module or entry point.
+
+        :param target: The module e.g. "pkg.cli" or entry point e.g.
+            "pkg.cli:main"
+        :return: List of arguments
+        """
+        if ":" not in target:
+            return ["-m", target]
+
+        module, attributes = target.split(":", 1)
+
+        return [
+            "-c",
+            f"import sys, {module}; sys.argv[0] = {target!r}; "
+            f"sys.exit({module}.{attributes}())",
+        ]
+
+    @staticmethod
+    def _flatten(spec, parent=""):
+        """Iterate over the (path, content) pairs of a spec, see
+        populate(...)."""
+        items = spec.items() if isinstance(spec, dict) else spec
+
+        for path, content in items:
+            path = f"{parent}{path}"
+
+            yield path, content
+
+            if isinstance(content, dict):
+                yield from TestDirectory._flatten(content, parent=f"{path}/")
+
+    def _acquire(self, weight):
+        """Wait for free slots to run a command, see ProcessLimit.
+
+        :return: A context manager holding the slots
+        """
+        if self._shared.processlimit is None:
+            return contextlib.nullcontext()
+
+        return self._shared.processlimit.acquire(weight=weight)
+
+    def _record(self, result):
+        """Pass the result of a command to the usage report, if any."""
+        if self._shared.record is not None:
+            self._shared.record(result)
+
+    @staticmethod
+    def _wait(popen, timeout=None):
+        """Wait for a command to exit and collect its resource usage.
+
+        :param popen: The Popen object of the command
+        :param timeout: The maximum time to wait in seconds or None
+        :return: A ResourceUsage object or None if os.wait4(...) is not
+            available or the command was already waited for
+        :raises: subprocess.TimeoutExpired if the command is still running
+            after the timeout
+        """
+        if not hasattr(os, "wait4") or popen.returncode is not None:
+            popen.wait(timeout=timeout)
+            return None
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        delay = 0.0005
+
+        while True:
+            try:
+                pid, status, rusage = os.wait4(
+                    popen.pid, 0 if deadline is None else os.WNOHANG
+                )
+            except ChildProcessError:
+                # Reaped elsewhere, let Popen sort out the return code
+                popen.wait()
+                return None
+
+            if pid == popen.pid:
+                popen.returncode = TestDirectory._exitcode(status)
+                return resourceusage.ResourceUsage.from_rusage(rusage)
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise subprocess.TimeoutExpired(popen.args, timeout)
+
+            # Same back off as Popen.wait(...)
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, 0.05)
+
+    @staticmethod
+    def _exitcode(status):
+        """:return: The return code of a wait status like Popen sets it,
+        os.waitstatus_to_exitcode(...) requires Python 3.9"""
+        if os.WIFSIGNALED(status):
+            return -os.WTERMSIG(status)
+
+        return os.WEXITSTATUS(status)
+
+    @staticmethod
+    def _remaining(deadline):
+        """:return: The seconds left until a time.perf_counter() deadline or
+        None if there is no deadline"""
+        if deadline is None:
+            return None
+
+        return max(0, deadline - time.perf_counter())
+
+    @staticmethod
+    def _kill_process_tree(popen, session):
+        """Kill a running command and the processes it started.
+
+        :param popen: The Popen object of the command
+        :param session: True if the command was started in a new session
+            i.e. it is the leader of its own process group
+        """
+        if sys.platform == "win32":
+            subprocess.run(
+                ["taskkill", "/F", "/T", "/PID", str(popen.pid)],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+        elif session:
+            try:
+                os.killpg(popen.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+        # Make sure the command itself is killed
+        if sys.platform == "win32":
+            try:
+                popen.kill()
+            except OSError:
+                # The command already exited
+                pass
+        elif popen.returncode is None:
+            # Signal the process directly, Popen.kill(...) would reap it
+            # and discard its resource usage. The process is not reaped yet
+            # so its pid cannot have been reused.
+            try:
+                os.kill(popen.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
     def _create_symlink(self, source, link_name, isdir):
         """Create a symbolic link pointing to source named link_name."""
 
@@ -418,3 +1946,39 @@ class TestDirectory:
             )
 
         return files[0]
+
+
+# The characters which make a command string need the shell, see
+# TestDirectory._needs_shell(...). Quotes are not included as shlex.split(...)
+# handles them like the shell when there is nothing to expand.
+_SHELL_CHARACTERS = re.compile(r"[|&;<>()$`\\*?[#~\n]")
+
+
+class _Shared:
+    """State shared by a TestDirectory instance and the instances created
+    from it with e.g. mkdir(...) or join(...)."""
+
+    def __init__(self):
+        # The root directories of the overlays created with overlay_dir(...)
+        self.overlays = []
+
+        # Incremented whenever the files or directories change
+        self.generation = 0
+
+        # Called with the RunResult of each command, see UsageReport
+        self.record = None
+
+        # Limits the number of commands running at the same time
+        self.processlimit = None
+
+        # Runs the Python modules and entry points, see run_python(...)
+        self.pythonpool = None
+
+        # Deletes the directories removed with rmdir(...) in the background
+        self.trash = None
+
+        # The digests of the reference files, see assert_matches_tree(...)
+        self.hashcache = None
+
+        # The timeout used when a command is run without one
+        self.timeout = None
@@ -0,0 +1,266 @@
+import concurrent.futures
+import itertools
+import os
+import pathlib
+import shutil
+import stat
+import threading
+import warnings
+
+
+class Trash:
+    """Removes directories in the background.
+
+    A directory is first renamed into the trash directory, which is
+    instant, and then deleted by a pool of threads while the tests go on.
+    The sub-directories of a tree are deleted in parallel, which hides the
+    per file latency of e.g. NVMe drives and network file systems.
+
+    The trash directory must be on the same file system as the directories
+    removed. A directory which cannot be renamed, e.g. because it is on
+    another file system, is removed directly with shutil.rmtree(...).
+
+    The trash also decides which test directories are kept after the tests,
+    see release(...):
+
+    - "all" keeps every test directory, as pytest does by default.
+    - "failed" keeps only the directories of the tests which failed.
+    - "none" removes every test directory.
+
+    Example::
+
+        trash = Trash(path="/tmp/trash")
+        trash.remove("/tmp/build")
+        ...
+        trash.close()
+
+    Attributes:
+
+    :path: The trash directory as a pathlib.Path
+    :retention: Which test directories are kept, "all", "failed" or "none"
+    :max_size: The maximum total size in bytes of the test directories kept
+        or None for no maximum
+    :retained_size: The total size in bytes of the test directories kept
+    :errors: List of (path, exception) tuples for the files and directories
+        which could not be deleted
+    """
+
+    def __init__(self, path, retention="all", max_size=None, workers=None):
+        """Create a new Trash object
+
+        :param path: The trash directory as a string or pathlib.Path. It is
+            created when the first directory is removed.
+        :param retention: Which test directories are kept, "all", "failed"
+            or "none"
+        :param max_size: The maximum total size in bytes of the test
+            directories kept or None for no maximum. When it is reached the
+            following test directories are removed.
+        :param workers: The number of threads deleting files. If None the
+            default of concurrent.futures.ThreadPoolExecutor is used.
+        """
+        if retention not in ("all", "failed", "none"):
+            raise ValueError(f"Unknown retention {retention!r}")
+
+        self.path = pathlib.Path(path)
+        self.retention = retention
+        self.max_size = max_size
+        self.retained_size = 0
+        self.errors = []
+
+        self._workers = workers
+        self._pool = None
+        self._names = itertools.count()
+
+        # The number of directories being deleted, see wait(...)
+        self._pending = 0
+        self._condition = threading.Condition()
+
+    def remove(self, path):
+        """Remove a directory. It is renamed into the trash and deleted in
+        the background.
+
+        :param path: The directory to remove as a string or pathlib.Path
+        :raises: OSError if the path is a symlink, like shutil.rmtree(...)
+        """
+        # Deleting the contents would follow the link out of the tree
+        if os.path.islink(path):
+            raise OSError(f"Cannot call rmtree on a symbolic link: {path}")
+
+        with self._condition:
+            if self._pool is None:
+                self.path.mkdir(parents=True, exist_ok=True)
+                self._pool = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self._workers
+                )
+
+            trashed = self.path / str(next(self._names))
+
+        try:
+            os.rename(path, trashed)
+        except OSError:
+            shutil.rmtree(path)
+            return
+
+        with self._condition:
+            self._pending += 1
+
+        self._submit(_Directory(path=str(trashed), parent=None))
+
+    def release(self, path, failed):
+        """Keep or remove a test directory after its test, depending on the
+        retention.
+
+        :param path: The test directory as a string or pathlib.Path
+        :param failed: True if the test failed
+        :return: True if the test directory was kept
+        """
+        keep = self.retention == "all" or (self.retention == "failed" and failed)
+
+        if keep and self.max_size is not None:
+            size = _size(path)
+
+            with self._condition:
+                keep = self.retained_size + size <= self.max_size
+                if keep:
+                    self.retained_size += size
+
+        if not keep and os.path.isdir(path):
+            self.remove(path)
+
+        return keep
+
+    def wait(self):
+        """Wait for the directories removed to be deleted."""
+        with self._condition:
+            self._condition.wait_for(lambda: self._pending == 0)
+
+    def close(self):
+        """Wait for the directories removed to be deleted and stop the
+        threads. A warning is issued for the files and directories which
+        could not be deleted."""
+        self.wait()
+
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+        for path, error in self.errors:
+            warnings.warn(f"Could not delete {path}: {error}")
+
+    def _submit(self, directory):
+        self._pool.submit(self._delete, directory)
+
+    def _delete(self, directory):
+        """Delete the files in a directory and submit its sub-directories.
+        The directory itself is deleted when its sub-directories are."""
+        subdirectories = []
+
+        try:
+            # The sub-directories are known not to be links, but check the
+            # root in case it was replaced after it was renamed
+            if directory.parent is None and not stat.S_ISDIR(
+                os.lstat(directory.path).st_mode
+            ):
+                raise NotADirectoryError(f"Not a directory: {directory.path}")
+
+            with os.scandir(directory.path) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False) and not _is_junction(entry):
+                        subdirectories.append(entry.path)
+                    else:
+                        self._unlink(entry)
+
+        except OSError as error:
+            self._error(directory.path, error)
+
+        with self._condition:
+            directory.remaining += len(subdirectories)
+
+        for path in subdirectories:
+            self._submit(_Directory(path=path, parent=directory))
+
+        self._done(directory)
+
+    def _done(self, directory):
+        """Delete the directory, and its parents, if it was the last thing
+        left in them."""
+        while directory is not None:
+            with self._condition:
+                directory.remaining -= 1
+                if directory.remaining:
+                    return
+
+            try:
+                _retry(os.rmdir, directory.path)
+            except OSError as error:
+                self._error(directory.path, error)
+
+            if directory.parent is None:
+                with self._condition:
+                    self._pending -= 1
+                    self._condition.notify_all()
+
+            directory = directory.parent
+
+    def _unlink(self, entry):
+        try:
+            if _is_junction(entry):
+                _retry(os.rmdir, entry.path)
+            else:
+                _retry(os.unlink, entry.path)
+        except OSError as error:
+            self._error(entry.path, error)
+
+    def _error(self, path, error):
+        with self._condition:
+            self.errors.append((path, error))
+
+
+class _Directory:
+    """A directory being deleted by Trash."""
+
+    __slots__ = ("path", "parent", "remaining")
+
+    def __init__(self, path, parent):
+        self.path = path
+        self.parent = parent
+
+        # The number of sub-directories left plus one until the directory
+        # itself has been scanned
+        self.remaining = 1
+
+
+def _retry(function, path):
+    """Call function(path), if it is denied make the path and its parent
+    writable and try again, like for read-only files on Windows."""
+    try:
+        function(path)
+    except PermissionError:
+        for writable in (os.path.dirname(path), path):
+            try:
+                os.chmod(writable, os.stat(writable).st_mode | stat.S_IWRITE)
+            except OSError:
+                pass
+
+        function(path)
+
+
+def _is_junction(entry):
+    """:return: True if the entry is an NTFS junction, which must be removed
+    without following it"""
+    is_junction = getattr(entry, "is_junction", None)
+    return is_junction is not None and is_junction()
+
+
+def _size(path):
+    """:return: The total size in bytes of the files in a directory tree"""
+    size = 0
+
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+
+    return size
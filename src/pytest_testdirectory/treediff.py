@@ -0,0 +1,154 @@
+import concurrent.futures
+import difflib
+import os
+
+from . import snapshot
+
+
+class TreeDiff:
+    """Stores the differences between a directory tree and a reference tree,
+    see TreeDiff.compare(...).
+
+    Attributes:
+
+    :missing: Sorted list of the paths only in the reference tree
+    :unexpected: Sorted list of the paths only in the compared tree
+    :differing: Sorted list of the paths in both trees with different
+        content or kind
+    :diffs: Dict mapping each differing path to a textual diff as a string
+
+    The paths are relative to the roots of the trees using / as separator.
+    """
+
+    # The maximum number of lines of the diff shown for each file
+    max_diff_lines = 50
+
+    # The maximum size in bytes of the files diffed, difflib is quadratic in
+    # the worst case
+    max_diff_size = 1024 * 1024
+
+    def __init__(self, missing, unexpected, differing, diffs):
+        """Create a new TreeDiff object"""
+        self.missing = missing
+        self.unexpected = unexpected
+        self.differing = differing
+        self.diffs = diffs
+
+    @staticmethod
+    def compare(path, reference, hashcache=None, workers=None):
+        """Compare a directory tree with a reference tree.
+
+        The trees are compared in steps, each only done for the files which
+        are still undecided:
+
+        1. The paths, kinds and sizes, found in a single walk of each tree.
+        2. The SHA-256 digests of the files with the same size, hashed in
+           chunks by a pool of threads. The digests of the reference files
+           can be reused from a HashCache.
+        3. A textual diff of the files which differ.
+
+        Symlinks are not followed, their targets are compared.
+
+        :param path: The root of the tree as a string or pathlib.Path
+        :param reference: The root of the reference tree as a string or
+            pathlib.Path
+        :param hashcache: HashCache used for the reference files or None
+        :param workers: The number of threads hashing files. If None the
+            default of concurrent.futures.ThreadPoolExecutor is used.
+        :return: A TreeDiff object
+        """
+        actual = snapshot.Snapshot.create(path).entries
+        expected = snapshot.Snapshot.create(reference).entries
+
+        missing = sorted(expected.keys() - actual.keys())
+        unexpected = sorted(actual.keys() - expected.keys())
+        differing = []
+        candidates = []
+
+        for relative in expected.keys() & actual.keys():
+            kind, size = actual[relative][:2]
+
+            if kind != expected[relative][0]:
+                differing.append(relative)
+            elif kind == "link":
+                target = os.readlink(os.path.join(path, relative))
+                if target != os.readlink(os.path.join(reference, relative)):
+                    differing.append(relative)
+            elif kind == "file":
+                if size != expected[relative][1]:
+                    differing.append(relative)
+                elif size:
+                    candidates.append(relative)
+
+        reference_hash = (
+            snapshot.hash_file if hashcache is None else hashcache.hash_file
+        )
+
+        def same(relative):
+            return snapshot.hash_file(os.path.join(path, relative)) == reference_hash(
+                os.path.join(reference, relative)
+            )
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            for relative, equal in zip(candidates, pool.map(same, candidates)):
+                if not equal:
+                    differing.append(relative)
+
+        differing.sort()
+
+        diffs = {
+            relative: TreeDiff._diff(
+                os.path.join(reference, relative), os.path.join(path, relative)
+            )
+            for relative in differing
+            if actual[relative][0] == "file" and expected[relative][0] == "file"
+        }
+
+        return TreeDiff(
+            missing=missing, unexpected=unexpected, differing=differing, diffs=diffs
+        )
+
+    @staticmethod
+    def _diff(expected, actual):
+        """:return: A unified diff of two text files as a string, or a note
+        if one of them is binary or too large"""
+        if max(os.path.getsize(expected), os.path.getsize(actual)) > (
+            TreeDiff.max_diff_size
+        ):
+            return "Files too large to diff"
+
+        try:
+            with open(expected, encoding="utf-8") as data:
+                before = data.read().splitlines()
+            with open(actual, encoding="utf-8") as data:
+                after = data.read().splitlines()
+        except UnicodeDecodeError:
+            return "Binary files differ"
+
+        lines = list(
+            difflib.unified_diff(before, after, "expected", "actual", lineterm="", n=2)
+        )
+
+        if len(lines) > TreeDiff.max_diff_lines:
+            omitted = len(lines) - TreeDiff.max_diff_lines
+            lines = lines[: TreeDiff.max_diff_lines]
+            lines.append(f"[... {omitted} lines omitted ...]")
+
+        return "\n".join(lines)
+
+    def __bool__(self):
+        """:return: True if the trees differ"""
+        return bool(self.missing or self.unexpected or self.differing)
+
+    def __str__(self):
+        """Print the TreeDiff object as a string"""
+        lines = [f"- {path}" for path in self.missing]
+        lines += [f"+ {path}" for path in self.unexpected]
+
+        for path in self.differing:
+            lines.append(f"M {path}")
+
+            if path in self.diffs:
+                lines += ["    " + line for line in self.diffs[path].split("\n")]
+
+        return "\n".join(lines)
@@ -0,0 +1,21 @@
+class TreeMismatchError(AssertionError):
+    """Exception raised by TestDirectory.assert_matches_tree(...) when a
+    directory does not match the reference tree.
+
+    It is an AssertionError, so pytest reports it as a failed assertion.
+
+    Attributes:
+
+    :path: The path of the directory as a pathlib.Path
+    :reference: The path of the reference tree
+    :diff: The TreeDiff with the missing, unexpected and differing paths
+    """
+
+    def __init__(self, path, reference, diff):
+        super(TreeMismatchError, self).__init__(
+            "The directory {} does not match {}:\n{}".format(path, reference, diff)
+        )
+
+        self.path = path
+        self.reference = reference
+        self.diff = diff
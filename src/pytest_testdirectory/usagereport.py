@@ -0,0 +1,138 @@
+import json
+import os
+import threading
+
+import pytest
+
+
+class UsageReport:
+    """Collects the time and resources used by the commands run in each test
+    and reports them in the terminal summary and/or as a JSON file.
+
+    The report is registered as a pytest plugin when the
+    --testdirectory-durations or --testdirectory-report options are used.
+
+    With pytest-xdist each worker attaches the commands run by a test to
+    its teardown report, which is sent to the controller, so the terminal
+    summary and the report of the controller include every test.
+
+    Attributes:
+
+    :durations: The number of tests to list in the terminal summary, 0 for
+        all tests or None to not list any
+    :path: The path of the JSON report as a string or None
+    :worker: True if running in a pytest-xdist worker
+    :tests: Dict mapping the node id of each test to the list of commands
+        it ran, see record(...)
+    """
+
+    def __init__(self, durations=None, path=None, worker=False):
+        """Create a new UsageReport object
+
+        :param durations: The number of tests to list in the terminal
+            summary, 0 for all tests or None to not list any
+        :param path: The path of the JSON report as a string or None
+        :param worker: True if running in a pytest-xdist worker
+        """
+        self.durations = durations
+        self.path = path
+        self.worker = worker
+        self.tests = {}
+        self.lock = threading.Lock()
+
+    def record(self, nodeid, result):
+        """Record the time and resources used by a command.
+
+        :param nodeid: The node id of the test running the command
+        :param result: The RunResult of the command
+        """
+        command = {"command": str(result.command), "time": result.time}
+
+        if result.resources is not None:
+            command.update(result.resources.to_dict())
+
+        # Commands may be run from several threads e.g. by run_many(...)
+        with self.lock:
+            self.tests.setdefault(nodeid, []).append(command)
+
+    def summary(self):
+        """:return: A list with a dict per test with the number of commands,
+        their total time and CPU time and the largest maximum resident set
+        size, sorted by the time used"""
+        tests = []
+
+        for nodeid, commands in self.tests.items():
+            tests.append(
+                {
+                    "nodeid": nodeid,
+                    "commands": len(commands),
+                    "time": sum(c["time"] for c in commands),
+                    "cpu_time": sum(
+                        c.get("user_time", 0) + c.get("system_time", 0)
+                        for c in commands
+                    ),
+                    "max_rss": max(c.get("max_rss", 0) for c in commands),
+                }
+            )
+
+        return sorted(tests, key=lambda test: test["time"], reverse=True)
+
+    @pytest.hookimpl(tryfirst=True)
+    def pytest_runtest_logreport(self, report):
+        if report.when != "teardown":
+            return
+
+        if self.worker:
+            # Attached before pytest-xdist sends the report to the
+            # controller, the attributes of a report are serialized with it
+            with self.lock:
+                commands = self.tests.get(report.nodeid)
+
+            if commands is not None:
+                report.testdirectory_usage = list(commands)
+
+            return
+
+        commands = getattr(report, "testdirectory_usage", None)
+        if commands is not None:
+            with self.lock:
+                self.tests.setdefault(report.nodeid, []).extend(commands)
+
+    def pytest_terminal_summary(self, terminalreporter):
+        if self.durations is None:
+            return
+
+        tests = self.summary()
+        if self.durations > 0:
+            tests = tests[: self.durations]
+
+        terminalreporter.write_sep("=", "testdirectory command usage")
+
+        for test in tests:
+            terminalreporter.write_line(
+                "{:8.2f}s wall {:8.2f}s cpu {:8.1f} MiB rss {:4d} commands"
+                "  {}".format(
+                    test["time"],
+                    test["cpu_time"],
+                    test["max_rss"] / (1024 * 1024),
+                    test["commands"],
+                    test["nodeid"],
+                )
+            )
+
+    def pytest_sessionfinish(self, session):
+        if self.path is None:
+            return
+
+        path = self.path
+
+        # Each pytest-xdist worker writes its own report
+        workerinput = getattr(session.config, "workerinput", None)
+        if workerinput is not None:
+            root, ext = os.path.splitext(path)
+            path = "{}-{}{}".format(root, workerinput["workerid"], ext)
+
+        with open(path, "w") as report:
+            json.dump(
+                {"summary": self.summary(), "tests": self.tests}, report, indent=2
+            )
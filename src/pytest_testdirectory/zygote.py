@@ -0,0 +1,237 @@
+"""The server forking the Python interpreters of a PythonPool.
+
+The script is run by path with the modules to preload as arguments. It
+reads requests from stdin and writes responses to stdout, each a JSON
+object on a line. The modules imported by the server may print, so the
+responses are written to a private duplicate of stdout, and stdout
+itself is pointed at the null device:
+
+- ``{"id": 1, "target": "pkg.cli", "args": [...], "cwd": ..., "env": {...},
+  "stdout": path, "stderr": path}`` forks a child running the target and
+  responds with ``{"id": 1, "returncode": 0, "rusage": {...}}`` when the
+  child has exited.
+- ``{"kill": 1}`` kills the child running request 1 and the processes it
+  started.
+- ``{"import": "pkg"}`` imports a module in the server, so later children
+  start with it imported.
+
+Only the standard library is used, as the script must not import the
+package it is part of.
+"""
+
+import atexit
+import importlib
+import json
+import os
+import runpy
+import select
+import signal
+import sys
+import traceback
+
+
+def main():
+    # Running the script put its directory first on the path
+    del sys.path[0]
+
+    # Keep the protocol away from anything printed by the imported modules
+    protocol = os.dup(1)
+    null = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(null, 1)
+    os.close(null)
+
+    for module in sys.argv[1:]:
+        _import(module)
+
+    # Wake up select(...) when a child exits
+    wakeup_read, wakeup_write = os.pipe()
+    os.set_blocking(wakeup_write, False)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+    signal.set_wakeup_fd(wakeup_write)
+
+    # Maps the pid of each running child to the id of its request
+    children = {}
+    pending = b""
+
+    while True:
+        readable, _, _ = select.select([0, wakeup_read], [], [])
+
+        if wakeup_read in readable:
+            os.read(wakeup_read, 4096)
+
+        if 0 in readable:
+            data = os.read(0, 64 * 1024)
+
+            if not data:
+                break
+
+            lines = (pending + data).split(b"\n")
+            pending = lines.pop()
+
+            for line in lines:
+                request = json.loads(line)
+
+                if "import" in request:
+                    _import(request["import"])
+                elif "kill" in request:
+                    for pid, id in children.items():
+                        if id == request["kill"]:
+                            _kill(pid)
+                else:
+                    pid = os.fork()
+
+                    if pid == 0:
+                        code = 1
+                        try:
+                            os.close(wakeup_read)
+                            os.close(wakeup_write)
+                            os.close(protocol)
+                            code = _child(request)
+                        finally:
+                            # Never return to the loop of the server
+                            os._exit(code)
+
+                    children[pid] = request["id"]
+
+        _reap(children, protocol)
+
+    # The pool was closed
+    for pid in children:
+        _kill(pid)
+
+
+def _import(module):
+    try:
+        importlib.import_module(module)
+    except Exception:
+        # The child importing it reports the error
+        pass
+    finally:
+        # Output buffered by the import must not be inherited by the
+        # children
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+
+def _kill(pid):
+    # The child may not have created its process group yet
+    for kill in (os.killpg, os.kill):
+        try:
+            kill(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
+def _reap(children, protocol):
+    """Respond to the requests of the children which have exited.
+
+    :param children: Dict mapping the pid of each child to its request id
+    :param protocol: The file descriptor the responses are written to
+    """
+    while children:
+        pid, status, rusage = os.wait4(-1, os.WNOHANG)
+
+        if pid == 0:
+            return
+
+        response = {
+            "id": children.pop(pid),
+            "returncode": _exitcode(status),
+            "rusage": {
+                name: getattr(rusage, name)
+                for name in dir(rusage)
+                if name.startswith("ru_")
+            },
+        }
+
+        # Written unbuffered, so the children cannot inherit pending output
+        os.write(protocol, json.dumps(response).encode() + b"\n")
+
+
+def _exitcode(status):
+    """:return: The return code of a wait status like Popen sets it,
+    os.waitstatus_to_exitcode(...) requires Python 3.9"""
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+
+    return os.WEXITSTATUS(status)
+
+
+def _child(request):
+    """Run the target of a request in a forked child.
+
+    :return: The exit code
+    """
+    signal.set_wakeup_fd(-1)
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+
+    # Lead a new process group, so the processes the target starts are
+    # killed with it
+    os.setsid()
+
+    null = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(null, 0)
+    os.close(null)
+
+    for fd, path in ((1, request["stdout"]), (2, request["stderr"])):
+        output = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        os.dup2(output, fd)
+        os.close(output)
+
+    os.chdir(request["cwd"])
+    os.environ.clear()
+    os.environ.update(request["env"])
+
+    # The path is set up when the interpreter starts, so apply the
+    # PYTHONPATH of the request like a new interpreter would
+    pythonpath = request["env"].get("PYTHONPATH", "")
+    sys.path[0:0] = [path for path in pythonpath.split(os.pathsep) if path]
+
+    # Like python -m and python -c the current directory is first on the
+    # path
+    sys.path.insert(0, request["cwd"])
+
+    target = request["target"]
+    code = 0
+
+    try:
+        if ":" in target:
+            # An entry point like the console scripts created by pip
+            module, attributes = target.split(":", 1)
+            sys.argv = [target] + request["args"]
+
+            function = importlib.import_module(module)
+            for attribute in attributes.split("."):
+                function = getattr(function, attribute)
+
+            sys.exit(function())
+        else:
+            sys.argv = [target] + request["args"]
+            runpy.run_module(target, run_name="__main__", alter_sys=True)
+
+    except SystemExit as exit:
+        if exit.code is None:
+            code = 0
+        elif isinstance(exit.code, int):
+            code = exit.code
+        else:
+            print(exit.code, file=sys.stderr)
+            code = 1
+
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+
+    # Shut down like the interpreter would
+    try:
+        atexit._run_exitfuncs()
+        sys.stdout.flush()
+        sys.stderr.flush()
+    except BaseException:
+        pass
+
+    return code
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,27 @@
+import asyncio
 import os
+import shutil
+import sys
+import threading
+import time
+import types
+
+import pytest
+
+from pytest_testdirectory import parallelcopy
+from pytest_testdirectory.checkoutput import CheckOutput
+from pytest_testdirectory.hashcache import HashCache
+from pytest_testdirectory.processlimit import ProcessLimit, fcntl
+from pytest_testdirectory.pythonpool import PythonPool
+from pytest_testdirectory.runmanyerror import RunManyError
+from pytest_testdirectory.runresulterror import RunResultError
+from pytest_testdirectory.runtimeouterror import RunTimeoutError
+from pytest_testdirectory.sealederror import SealedError
+from pytest_testdirectory.syntheticfile import SyntheticFile
+from pytest_testdirectory.templatecache import TemplateCache
+from pytest_testdirectory.trash import Trash
+from pytest_testdirectory.treemismatcherror import TreeMismatchError
+from pytest_testdirectory.usagereport import UsageReport
 
 
 def test_run(testdirectory):
@@ -126,6 +149,9 @@ def test_contains_dir(testdirectory):
     assert sub1.contains_dir("sub2")
     assert not sub1.contains_dir("nothere")
 
+    # Without arguments the directory itself is checked
+    assert sub1.contains_dir()
+
 
 def test_contains_dir_glob(testdirectory):
     sub1 = testdirectory.mkdir("sub1")
@@ -147,6 +173,12 @@ def test_copy_file(testdirectory):
     assert sub2.contains_file("ok.txt")
     assert os.path.isfile(copy_path)
 
+    # Copying a file onto itself must not truncate it
+    with pytest.raises(shutil.SameFileError):
+        sub2.copy_file(copy_path)
+    with open(copy_path, encoding="utf-8") as f:
+        assert f.read() == "hello_world"
+
 
 def test_copy_dir(testdirectory):
     sub1 = testdirectory.mkdir("sub1")
@@ -182,3 +214,823 @@ def test_rmfile(testdirectory):
     sub1.rmfile("ok.txt")
 
     assert not sub1.contains_file("ok.txt")
+
+
+def test_run_capture_file(testdirectory):
+    testdirectory.write_text("count.py", "for i in range(100000):\n    print(i)\n")
+    r = testdirectory.run("python count.py", capture="file")
+
+    assert r.stdout.match("99999")
+    assert not r.stdout.match("100000")
+    assert testdirectory.contains_file(r.stdout.path.name)
+
+    # Only the beginning and the end of large outputs are included
+    assert len(str(r.stdout)) < r.stdout.path.stat().st_size
+    assert str(r.stdout).startswith("0\n1\n")
+    assert str(r.stdout).endswith("99998\n99999")
+
+    # The lines are read from the file
+    assert r.stdout.output[:2] == ["0", "1"]
+    assert len(r.stdout.output) == 100000
+
+    # Invalid bytes are replaced and the lines are split the same way as in
+    # memory, also when counting and indexing
+    testdirectory.write_text(
+        "odd.py", "import sys\nsys.stdout.buffer.write(b'a\\x0cb\\r\\nc\\xff\\n')\n"
+    )
+    r = testdirectory.run("python odd.py", capture="file", encoding="utf-8")
+    assert r.stdout.output == ["a", "b", "c\ufffd"]
+    assert r.stdout.find("c*") == [2]
+    assert len(r.stdout) == 3
+    assert r.stdout[1] == "b"
+
+    r = testdirectory.run("python odd.py", capture="file", encoding="latin-1")
+    assert r.stdout.match("c\xff")
+
+
+def test_match_any_match_all(testdirectory):
+    testdirectory.write_text("log.py", "print('started')\nprint('finished')\n")
+    r = testdirectory.run("python log.py")
+
+    assert r.stdout.match_any(["*nothere*", "start*"])
+    assert not r.stdout.match_any(["*nothere*"])
+    assert not r.stdout.match_any([])
+
+    assert r.stdout.match_all(["start*", "*finish*", "*ed"])
+    assert not r.stdout.match_all(["start*", "*nothere*"])
+    assert r.stdout.match_all([])
+
+    r = testdirectory.run("python log.py", capture="file")
+
+    assert r.stdout.match_all(["start*", "*finish*"])
+    assert not r.stdout.match_any(["*nothere*"])
+
+
+def test_checkoutput_index():
+    out = CheckOutput("connecting\nretry 1\nconnected\r\nretry 2\nclosed\n")
+
+    assert len(out) == 5
+    assert out[2] == "connected"
+    assert out[-1] == "closed"
+    assert out.output == ["connecting", "retry 1", "connected", "retry 2", "closed"]
+
+    assert out.find("retry *") == [1, 3]
+    assert out.find("*nothere*") == []
+    assert out.count("*connect*") == 2
+    assert out.count("[cr]*") == 5
+
+    assert out.match_in_order(["*connecting*", "*connected*", "*closed*"])
+    assert out.match_in_order(["retry *", "retry *"])
+    assert not out.match_in_order(["*connected*", "*connecting*"])
+    assert not out.match_in_order(["retry *", "retry *", "retry *"])
+    assert out.match_in_order([])
+
+    tail = out[3:]
+    assert tail.output == ["retry 2", "closed"]
+    assert tail.find("retry *") == [0]
+    assert not tail.match("*connect*")
+    assert str(out[::2]) == "connecting\nconnected\nclosed"
+
+
+def test_checkoutput_dense(monkeypatch):
+    # Patterns whose literal part is in most lines are matched in a single
+    # pass instead of searching the output for each of them
+    monkeypatch.setattr(CheckOutput, "dense_lines", 2)
+    out = CheckOutput("".join(f"line {i}\n" for i in range(20)) + "done\n")
+
+    assert out.match_any(["*line*x*", "*line*1?"])
+    assert not out.match_any(["*line*x*", "*line*y*", "*nothere*"])
+    assert out.match_all(["*line*1?", "*line 3", "done"])
+    assert not out.match_all(["*line*1?", "*line*x*"])
+    assert not out.match_all(["*line*1?", "*nothere*"])
+    assert out.find("line 1*") == [1] + list(range(10, 20))
+
+
+def test_checkoutput_compress(testdirectory):
+    text = "".join(f"[{i}] building module_{i}.o\n" for i in range(100))
+    out = CheckOutput(text, compress=True)
+
+    assert out.compressed
+    assert len(out) == 100
+    assert out[5] == "[5] building module_5.o"
+    assert out.output == text.splitlines()
+    assert out.find("*module_9?.o") == list(range(90, 100))
+    assert out.match_in_order(["*module_1.o", "*module_2.o"])
+    assert out[90:].count("*building*") == 10
+    assert str(out) == text.strip()
+
+    out.output = ["replaced"]
+    assert out.compressed
+    assert out.match("replaced")
+
+    testdirectory.write_text("log.py", "print('ready')\nprint('done')\n")
+
+    r = testdirectory.run("python log.py", compress=True)
+    assert r.stdout.compressed
+    assert r.stdout.match_all(["ready", "done"])
+    assert not hasattr(r, "__dict__")
+
+    with pytest.raises(ValueError):
+        testdirectory.run("python log.py", capture="file", compress=True)
+
+    # Output captured to a file or as bytes is never compressed
+    assert not testdirectory.run("python log.py", capture="file").stdout.compressed
+    assert not testdirectory.run("python log.py", capture="bytes").stdout.compressed
+
+
+def test_run_many(testdirectory):
+    testdirectory.write_text("echo.py", "import sys\nprint(sys.argv[1])\n")
+
+    results = testdirectory.run_many(
+        [f"python echo.py {i}" for i in range(8)], workers=4
+    )
+
+    assert [str(r.stdout) for r in results] == [str(i) for i in range(8)]
+
+    with pytest.raises(RunManyError) as e:
+        testdirectory.run_many(["python echo.py ok", "python nothere.py"])
+
+    assert len(e.value.errors) == 1
+    assert len(e.value.runresults) == 2
+    assert e.value.runresult.command == "python nothere.py"
+    assert e.value.runresults[0].stdout.match("ok")
+
+
+def test_arun(testdirectory):
+    testdirectory.write_text("log.py", "print('ready')\nprint('done')\n")
+
+    lines = []
+
+    async def on_stdout(line):
+        lines.append(line)
+
+    r = asyncio.run(testdirectory.arun("python log.py", on_stdout=on_stdout))
+
+    assert lines == ["ready", "done"]
+    assert r.stdout.match_all(["ready", "done"])
+    assert r.returncode == 0
+
+    r = asyncio.run(testdirectory.arun(["python", "log.py"], shell=False))
+    assert r.stdout.match("ready")
+
+    with pytest.raises(RunResultError):
+        asyncio.run(testdirectory.arun("python nothere.py"))
+
+
+def test_run_until(testdirectory):
+    testdirectory.write_text(
+        "server.py",
+        "import sys, time\n"
+        "print('starting')\n"
+        "print('listening on 8080', flush=True)\n"
+        "time.sleep(60)\n",
+    )
+
+    r = testdirectory.run("python server.py", until="*listening on*", timeout=30)
+
+    assert r.stdout.match_all(["starting", "listening on 8080"])
+    assert r.time < 30
+
+    with pytest.raises(RunTimeoutError) as e:
+        testdirectory.run("python server.py", until="*nothere*", timeout=1)
+
+    assert e.value.timeout == 1
+    assert e.value.runresult.stdout.match("starting")
+
+    r = testdirectory.run(
+        "python server.py", capture="file", until=["*nothere*", "listening*"]
+    )
+    assert r.stdout.match("listening on 8080")
+
+    # The command exits without printing the pattern
+    with pytest.raises(RunResultError):
+        testdirectory.run("python --version", until="*nothere*")
+
+
+def test_run_timeout(testdirectory):
+    testdirectory.write_text(
+        "hang.py",
+        "import time\n" "print('started', flush=True)\n" "time.sleep(60)\n",
+    )
+
+    with pytest.raises(RunTimeoutError) as e:
+        testdirectory.run("python hang.py", timeout=1)
+
+    assert e.value.timeout == 1
+    assert e.value.runresult.stdout.match("started")
+    assert e.value.runresult.time < 30
+
+    with pytest.raises(RunTimeoutError) as e:
+        asyncio.run(testdirectory.arun("python hang.py", timeout=1))
+
+    assert e.value.runresult.stdout.match("started")
+
+    if sys.platform == "win32":
+        return
+
+    # The command exits, but leaves a process holding on to its output
+    testdirectory.write_text(
+        "orphan.py",
+        "import subprocess, sys\n" "subprocess.Popen([sys.executable, 'hang.py'])\n",
+    )
+
+    with pytest.raises(RunTimeoutError) as e:
+        testdirectory.run("python orphan.py", timeout=1)
+
+    assert e.value.runresult.returncode == 0
+    assert e.value.runresult.stdout.match("started")
+
+
+def test_templatecache(testdirectory, monkeypatch):
+    source = testdirectory.mkdir("source")
+    source.write_text("ok.txt", "hello_world", encoding="utf-8")
+
+    cache = TemplateCache(path=testdirectory.mkdir("cache").path())
+
+    # Emulate a file system with reflink support
+    cache.reflink = True
+    cache._clone = shutil.copy2
+
+    cache.copy_dir(source=source.path(), destination=testdirectory.tmpdir / "copy1")
+    assert testdirectory.join("copy1").contains_file("ok.txt")
+    assert len(cache.entries) == 1
+
+    # Changing the source invalidates the cached copy
+    source.write_text("ok.txt", "hello_world_changed", encoding="utf-8")
+
+    cache.copy_dir(source=source.path(), destination=testdirectory.tmpdir / "copy2")
+    copy2 = testdirectory.tmpdir / "copy2" / "ok.txt"
+    assert copy2.read_text(encoding="utf-8") == "hello_world_changed"
+    assert len(list(cache.path.iterdir())) == 1
+
+    # A failed copy into the cache leaves nothing behind, so the next copy
+    # of the source succeeds
+    new_path = source.write_text("new.txt", "new", encoding="utf-8")
+
+    def fail(source, destination):
+        raise OSError("No space left on device")
+
+    monkeypatch.setattr(parallelcopy, "copy2", fail)
+    with pytest.raises(OSError):
+        cache.copy_file(source=new_path, destination=testdirectory.tmpdir)
+    assert len(list(cache.path.iterdir())) == 1
+
+    monkeypatch.undo()
+    cache.copy_file(source=new_path, destination=testdirectory.tmpdir / "new.txt")
+    assert testdirectory.contains_file("new.txt")
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_copy_dir_metadata(testdirectory, workers):
+    source = testdirectory.mkdir("source")
+    nested = source.mkdir("nested")
+    ok_path = nested.write_text("ok.txt", "hello_world", encoding="utf-8")
+    os.chmod(ok_path, 0o750)
+
+    for path in [ok_path, nested.tmpdir, source.tmpdir]:
+        os.utime(path, (1000000000, 1000000000))
+
+    copy = testdirectory.mkdir("copy").copy_dir(source.path(), workers=workers)
+
+    for path in ["nested/ok.txt", "nested", "."]:
+        assert os.stat(copy.tmpdir / path).st_mtime == 1000000000
+
+    assert os.stat(copy.tmpdir / "nested" / "ok.txt").st_mode & 0o777 == 0o750
+
+
+def test_overlay_dir(testdirectory):
+    source = testdirectory.mkdir("source")
+    source.mkdir("nested").write_text("ok.txt", "hello_world", encoding="utf-8")
+    source.write_text("ok2.txt", "hello_world2", encoding="utf-8")
+
+    overlay = testdirectory.mkdir("sub").overlay_dir(source.path())
+
+    assert overlay.contains_file("ok2.txt")
+    assert overlay.contains_file("nested/ok.txt")
+    assert os.path.islink(overlay.tmpdir / "ok2.txt")
+
+    # Writing to a file does not change the source
+    nested = overlay.join("nested")
+    nested.write_text("ok.txt", "changed", encoding="utf-8")
+    assert not os.path.islink(nested.tmpdir / "ok.txt")
+    assert source.tmpdir.joinpath("nested", "ok.txt").read_text() == "hello_world"
+
+    copy_path = overlay.materialize("ok2.txt")
+    assert not os.path.islink(copy_path)
+    assert copy_path.read_text() == "hello_world2"
+
+    overlay.rmfile("ok2.txt")
+    assert source.contains_file("ok2.txt")
+
+    # Copying files over the ones in an overlay does not change the source
+    other = testdirectory.mkdir("other")
+    other.write_text("ok2.txt", "copied", encoding="utf-8")
+    other.mkdir("nested").write_text("ok.txt", "copied", encoding="utf-8")
+
+    overlay = testdirectory.mkdir("sub2").overlay_dir(source.path())
+    overlay.copy_file(os.path.join(other.path(), "ok2.txt"))
+    overlay.join("nested").copy_files(os.path.join(other.path(), "nested", "*"))
+
+    assert overlay.tmpdir.joinpath("ok2.txt").read_text() == "copied"
+    assert overlay.tmpdir.joinpath("nested", "ok.txt").read_text() == "copied"
+    assert source.tmpdir.joinpath("ok2.txt").read_text() == "hello_world2"
+    assert source.tmpdir.joinpath("nested", "ok.txt").read_text() == "hello_world"
+
+
+def test_snapshot_diff(testdirectory):
+    testdirectory.write_text("removed.txt", "hello_world", encoding="utf-8")
+    testdirectory.write_text("modified.txt", "hello_world", encoding="utf-8")
+    testdirectory.write_text("same.txt", "hello_world", encoding="utf-8")
+
+    before = testdirectory.snapshot(hash=True)
+
+    testdirectory.rmfile("removed.txt")
+    testdirectory.write_text("modified.txt", "hello_world_changed", encoding="utf-8")
+    testdirectory.mkdir("sub").write_text("added.txt", "hello", encoding="utf-8")
+
+    diff = testdirectory.diff(before)
+
+    assert diff.added == ["sub", "sub/added.txt"]
+    assert diff.removed == ["removed.txt"]
+    assert diff.modified == ["modified.txt"]
+    assert not testdirectory.diff(testdirectory.snapshot())
+
+    testdirectory.write_text("touch.py", "open('new.txt', 'w').close()\n")
+    r = testdirectory.run("python touch.py", capture="file", snapshot=True)
+    assert r.diff.added == ["new.txt"]
+    assert not r.diff.modified
+
+
+def test_index(testdirectory):
+    testdirectory.enable_index()
+
+    sub1 = testdirectory.mkdir("sub1")
+    sub1.write_text("ok.txt", "hello_world", encoding="utf-8")
+    sub1.mkdir("sub2")
+    testdirectory.symlink_dir(sub1.path(), rename_as="link")
+
+    assert testdirectory.contains_file("sub1/ok.txt")
+    assert testdirectory.contains_file("sub*/*.txt")
+    assert testdirectory.contains_file("link/ok.txt")
+    assert not testdirectory.contains_file("sub1/nothere.txt")
+    assert testdirectory.contains_dir("sub1", "sub2")
+    assert testdirectory.contains_dir("s*", "sub?")
+    assert not testdirectory.contains_dir("sub1", "nothere")
+    assert testdirectory.contains_dir()
+
+    # The index is updated by the methods changing the directory
+    sub1.write_text("ok2.txt", "hello_world", encoding="utf-8")
+    assert testdirectory.contains_file("sub1/ok2.txt")
+
+    sub1.rmfile("ok2.txt")
+    assert not testdirectory.contains_file("sub1/ok2.txt")
+
+    testdirectory.run("python -c \"open('sub1/ok3.txt', 'w').close()\"")
+    assert testdirectory.contains_file("sub1/ok3.txt")
+
+    # Changes made without using TestDirectory require a refresh
+    open(os.path.join(sub1.path(), "ok4.txt"), "w").close()
+    testdirectory.refresh()
+    assert testdirectory.contains_file("sub1/ok4.txt")
+
+
+def test_resources(testdirectory):
+    testdirectory.write_text(
+        "work.py", "data = b'x' * (64 * 1024 * 1024)\nprint(sum(range(10**6)))\n"
+    )
+
+    r = testdirectory.run("python work.py")
+    assert r.stdout.match(str(sum(range(10**6))))
+
+    if not hasattr(os, "wait4"):
+        assert r.resources is None
+        return
+
+    assert r.resources.cpu_time > 0
+    assert r.resources.max_rss > 64 * 1024 * 1024
+    assert r.resources.minor_faults > 0
+
+    report = UsageReport(durations=0)
+    report.record("test_a", r)
+    report.record("test_b", testdirectory.run("python --version"))
+    report.record("test_b", r)
+
+    summary = report.summary()
+    assert [test["nodeid"] for test in summary] == ["test_b", "test_a"]
+    assert summary[0]["commands"] == 2
+    assert summary[0]["max_rss"] == r.resources.max_rss
+
+    # A pytest-xdist worker passes the commands to the controller with the
+    # teardown report
+    worker = UsageReport(worker=True)
+    worker.record("test_c", r)
+    teardown = types.SimpleNamespace(nodeid="test_c", when="teardown")
+    worker.pytest_runtest_logreport(teardown)
+
+    report.pytest_runtest_logreport(teardown)
+    assert report.tests["test_c"] == worker.tests["test_c"]
+
+
+@pytest.mark.skipif(fcntl is None, reason="Requires fcntl")
+def test_processlimit(testdirectory):
+    limit = ProcessLimit(path=testdirectory.mkdir("locks").path(), slots=3)
+    running = []
+    peak = []
+    lock = threading.Lock()
+
+    def work(weight):
+        # A weight larger than the limit takes all the slots
+        weight = min(weight, limit.slots)
+
+        with limit.acquire(weight=weight):
+            with lock:
+                running.append(weight)
+                peak.append(sum(running))
+            time.sleep(0.05)
+            with lock:
+                running.remove(weight)
+
+    threads = [threading.Thread(target=work, args=(w,)) for w in [1, 2, 3, 1, 5]]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert max(peak) <= 3
+
+    testdirectory._shared.processlimit = limit
+    testdirectory.write_text("sleep.py", "import time\ntime.sleep(0.2)\n")
+    testdirectory.run_many(["python sleep.py"] * 3, weight=2)
+
+
+def test_run_python(testdirectory):
+    testdirectory.write_text(
+        "tool.py",
+        "import os, sys\n"
+        "def main():\n"
+        "    print(os.getcwd(), sys.argv[1:], os.environ.get('TOOL'))\n"
+        "    os.environ['TOOL'] = 'changed'\n"
+        "    return 3 if '--fail' in sys.argv else 0\n"
+        "if __name__ == '__main__':\n"
+        "    sys.exit(main())\n",
+    )
+
+    r = testdirectory.run_python("tool", ["a", "b c"])
+    assert r.stdout.match(f"{testdirectory.path()} *'a', 'b c'* None")
+    assert r.command == "python -m tool a 'b c'"
+
+    env = dict(os.environ, PYTHONPATH=testdirectory.path(), TOOL="set")
+    r = testdirectory.run_python("tool:main", "x --flag", env=env)
+    assert r.stdout.match("* *'x', '--flag'* set")
+
+    # Entry points are found in the test directory with and without the pool
+    r = testdirectory.run_python("tool:main", "y")
+    assert r.stdout.match("* *'y'* None")
+
+    pool = testdirectory._shared.pythonpool
+    testdirectory._shared.pythonpool = None
+    r = testdirectory.run_python("tool:main", "y")
+    assert r.stdout.match("* *'y'* None")
+    testdirectory._shared.pythonpool = pool
+
+    with pytest.raises(RunResultError) as e:
+        testdirectory.run_python("tool", "--fail", capture="file")
+    assert e.value.runresult.returncode == 3
+    assert e.value.runresult.stdout.match("*None")
+
+    with pytest.raises(RunResultError) as e:
+        testdirectory.run_python("notamodule")
+    assert e.value.runresult.stderr.match("*No module named*")
+
+    testdirectory.write_text("sleep.py", "import time\ntime.sleep(60)\n")
+    with pytest.raises(RunTimeoutError):
+        testdirectory.run_python("sleep", timeout=0.5)
+
+
+@pytest.mark.skipif(not PythonPool.supported, reason="Requires fork")
+def test_pythonpool_noisy_import(testdirectory, monkeypatch):
+    # Output printed by the modules the zygote imports must not break the
+    # protocol
+    testdirectory.write_text(
+        "noisy.py", "print('imported')\ndef main():\n    print('run')\n"
+    )
+    monkeypatch.setenv("PYTHONPATH", testdirectory.path())
+
+    pool = PythonPool(preload=["noisy"])
+    try:
+        stdout = os.path.join(testdirectory.path(), "stdout.txt")
+        stderr = os.path.join(testdirectory.path(), "stderr.txt")
+
+        returncode, _, timed_out = pool.run(
+            target="noisy:main",
+            args=[],
+            cwd=testdirectory.path(),
+            env=os.environ,
+            stdout=stdout,
+            stderr=stderr,
+            timeout=30,
+        )
+    finally:
+        pool.close()
+
+    assert returncode == 0
+    assert not timed_out
+    with open(stdout) as f:
+        assert f.read() == "run\n"
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="Uses POSIX quoting")
+def test_run_shell(testdirectory):
+    testdirectory.write_text("args.py", "import sys\nprint(sys.argv[1:])\n")
+
+    # Lists are run without the shell and quoted in the command
+    r = testdirectory.run(["python", "args.py", "$HOME", "a b"])
+    assert r.stdout.match("*'$HOME', 'a b'*")
+    assert r.command == "python args.py '$HOME' 'a b'"
+
+    kwargs = {"cwd": testdirectory.path()}
+    needs_shell = testdirectory._needs_shell
+    assert not needs_shell("python args.py 'a b' --x=1", kwargs)
+    assert needs_shell("python args.py $HOME", kwargs)
+    assert needs_shell("python args.py *.py", kwargs)
+    assert needs_shell("python args.py > out.txt", kwargs)
+    assert needs_shell("FOO=1 python args.py", kwargs)
+    assert needs_shell("cd ..", kwargs)
+    assert needs_shell("./args.py", kwargs)
+
+    r = testdirectory.run("python args.py 'a b'")
+    assert r.stdout.match("*'a b'*")
+    assert r.command == "python args.py 'a b'"
+
+    r = testdirectory.run("python args.py *.py")
+    assert r.stdout.match("*'args.py'*")
+
+    # With shell=True a list is joined without quoting, as before
+    r = testdirectory.run(["python", "args.py", "*.py"], shell=True)
+    assert r.stdout.match("*'args.py'*")
+    assert r.command == "python args.py *.py"
+
+
+def test_env(testdirectory):
+    testdirectory.write_text(
+        "env.py", "import os\nprint(os.environ.get('A'), os.environ.get('PATH'))\n"
+    )
+
+    assert testdirectory.env.environ() is None
+
+    testdirectory.env.set("A", "1")
+    testdirectory.env.prepend_path("/first")
+    env = testdirectory.env.environ()
+    assert env["A"] == "1"
+    assert env["PATH"].startswith("/first" + os.pathsep)
+    assert testdirectory.env.environ() is env
+
+    r = testdirectory.run(["python", "env.py"])
+    assert r.stdout.match("1 /first*")
+    assert "A" not in os.environ or os.environ["A"] != "1"
+
+    sub = testdirectory.mkdir("sub")
+    sub.copy_file(os.path.join(testdirectory.path(), "env.py"))
+    sub.env.unset("A")
+    assert sub.run(["python", "env.py"]).stdout.match("None /first*")
+
+    # Changes of the parent are inherited
+    testdirectory.env.set("B", "2")
+    assert sub.env.environ()["B"] == "2"
+    assert "B" not in env
+
+    testdirectory.env.clear()
+    sub.env.clear()
+    assert sub.env.environ() is None
+
+
+def test_run_capture_bytes(testdirectory):
+    testdirectory.write_text(
+        "binary.py",
+        "import sys\n"
+        "sys.stdout.buffer.write(b'header\\r\\n\\xff\\xfe data \\x00\\nlast')\n",
+    )
+
+    r = testdirectory.run(["python", "binary.py"], capture="bytes")
+    assert bytes(r.stdout) == b"header\r\n\xff\xfe data \x00\nlast"
+    assert list(r.stdout) == [b"header", b"\xff\xfe data \x00", b"last"]
+
+    assert r.stdout.match(b"\xff\xfe*")
+    assert r.stdout.match("header")
+    assert not r.stdout.match("data*")
+    assert r.stdout.match_any([b"nothere", b"l?st"])
+    assert r.stdout.match_all([b"*data*", "header", b"last"])
+    assert not r.stdout.match_all([b"*data*", b"nothere"])
+    assert r.stdout.output[0] == "header"
+    assert str(r.stdout).startswith("header\n")
+
+
+def test_run_head_tail(testdirectory):
+    testdirectory.write_text(
+        "count.py",
+        "import sys\n"
+        "for i in range(100000):\n"
+        "    print(f'line {i}')\n"
+        "sys.stdout.write('end')\n",
+    )
+
+    r = testdirectory.run(["python", "count.py"], tail=2)
+    assert r.stdout.output == ["line 99999", "end"]
+    assert r.stdout.omitted_lines == 99999
+    assert r.stdout.omitted_bytes == len("".join(f"line {i}\n" for i in range(99999)))
+    assert str(r.stdout) == (
+        "[... 99999 lines ({} bytes) omitted ...]\nline 99999\nend".format(
+            r.stdout.omitted_bytes
+        )
+    )
+
+    r = testdirectory.run(["python", "count.py"], head=2, tail=1)
+    assert r.stdout.output == ["line 0", "line 1", "end"]
+    assert r.stdout.match("line 1")
+    assert not r.stdout.match("line 2")
+    assert str(r.stdout).startswith("line 0\nline 1\n[... 99998 lines")
+
+    r = testdirectory.run(["python", "count.py"], head=200000)
+    assert r.stdout.omitted_lines == 0
+    assert len(r.stdout.output) == 100001
+
+    r = testdirectory.run(["python", "count.py"], capture="discard")
+    assert r.stdout is None
+    assert r.returncode == 0
+
+    with pytest.raises(ValueError):
+        testdirectory.run(["python", "count.py"], capture="file", tail=1)
+
+
+def test_populate(testdirectory):
+    files = testdirectory.populate(
+        {
+            "a.txt": "hello",
+            "sub": {
+                "b.bin": b"\x00\x01",
+                "deep": {"c.txt": "c"},
+                "empty": {},
+            },
+            "random.bin": SyntheticFile(size=3 * 1024 * 1024 + 5, seed=1),
+            "pattern.txt": SyntheticFile(size=10, content="abc"),
+            "sparse.img": SyntheticFile(size=1024**3, sparse=True),
+        },
+        workers=2,
+    )
+
+    assert len(files) == 6
+    assert testdirectory.contains_file("a.txt")
+    assert testdirectory.contains_dir("sub/empty")
+    assert (testdirectory.tmpdir / "sub/b.bin").read_bytes() == b"\x00\x01"
+    assert (testdirectory.tmpdir / "sub/deep/c.txt").read_text() == "c"
+    assert (testdirectory.tmpdir / "pattern.txt").read_bytes() == b"abcabcabca"
+    assert (testdirectory.tmpdir / "sparse.img").stat().st_size == 1024**3
+
+    random_data = (testdirectory.tmpdir / "random.bin").read_bytes()
+    assert len(random_data) == 3 * 1024 * 1024 + 5
+    assert random_data != b"\x00" * len(random_data)
+
+    testdirectory.populate([("sub/b.bin", b"new"), ("other/d.txt", "d")])
+    assert (testdirectory.tmpdir / "sub/b.bin").read_bytes() == b"new"
+    assert (testdirectory.tmpdir / "other/d.txt").read_text() == "d"
+
+
+def test_fork_seal(module_testdirectory, testdirectory):
+    shared = module_testdirectory.mkdir("shared")
+    shared.write_text("a.txt", "a")
+    shared.seal()
+
+    work = shared.fork(testdirectory)
+    work.write_text("a.txt", "changed")
+    work.write_text("b.txt", "b")
+
+    overlay = shared.fork(testdirectory.mkdir("overlay"), overlay=True)
+    overlay.write_text("a.txt", "changed")
+
+    assert (shared.tmpdir / "a.txt").read_text() == "a"
+    shared.check_seal()
+
+    shared.write_text("c.txt", "c")
+
+    with pytest.raises(SealedError) as e:
+        shared.check_seal()
+
+    assert e.value.diff.added == ["c.txt"]
+
+    # Only reported once
+    shared.check_seal()
+
+
+def test_trash(testdirectory):
+    def tree(name):
+        directory = testdirectory.mkdir(name)
+        directory.populate({"a.txt": "a", "b": {"c": {"d.txt": "d"}}, "e": {}})
+        return directory.tmpdir
+
+    trash = Trash(path=testdirectory.tmpdir / "trash", retention="failed")
+
+    removed = tree("removed")
+    trash.remove(removed)
+    assert not removed.exists()
+
+    passed = tree("passed")
+    failed = tree("failed")
+    assert not trash.release(passed, failed=False)
+    assert trash.release(failed, failed=True)
+
+    trash.close()
+    assert not trash.errors
+    assert not passed.exists()
+    assert (failed / "b" / "c" / "d.txt").read_text() == "d"
+    assert os.listdir(trash.path) == []
+
+    # Only the failed test directories fitting in the maximum size are kept
+    trash = Trash(path=trash.path, max_size=3)
+    assert trash.release(tree("first"), failed=True)
+    assert not trash.release(tree("second"), failed=True)
+    trash.close()
+    assert trash.retained_size == 2
+
+
+def test_rmdir_symlink(testdirectory):
+    target = testdirectory.mkdir("target")
+    target.write_text("keep.txt", "keep")
+    link = testdirectory.symlink_dir(target.path(), rename_as="link")
+
+    # Like shutil.rmtree(...) a symlink is not removed, and the directory it
+    # points to is left alone
+    with pytest.raises(OSError):
+        testdirectory.join(os.path.basename(link)).rmdir()
+
+    testdirectory._shared.trash.wait()
+    assert target.contains_file("keep.txt")
+
+
+def test_assert_matches_tree(testdirectory):
+    spec = {
+        "same.txt": "same\n",
+        "size.txt": "a\n",
+        "content.txt": "one\ntwo\nthree\n",
+        "binary.bin": b"\x00\xff",
+        "missing.txt": "m",
+        "sub": {"nested.txt": "n"},
+    }
+    reference = testdirectory.mkdir("reference")
+    reference.populate(spec)
+
+    actual = testdirectory.mkdir("actual")
+    actual.populate(spec)
+    actual.assert_matches_tree(reference.tmpdir)
+
+    actual.write_text("size.txt", "ab\n")
+    actual.write_text("content.txt", "one\n2\nthree\n")
+    actual.write_binary("binary.bin", b"\xff\x00")
+    actual.rmfile("missing.txt")
+    actual.write_text("sub/unexpected.txt", "u")
+
+    with pytest.raises(TreeMismatchError) as e:
+        actual.assert_matches_tree(reference.tmpdir, workers=2)
+
+    diff = e.value.diff
+    assert diff.missing == ["missing.txt"]
+    assert diff.unexpected == ["sub/unexpected.txt"]
+    assert diff.differing == ["binary.bin", "content.txt", "size.txt"]
+    assert diff.diffs["binary.bin"] == "Binary files differ"
+    assert "-two\n+2" in diff.diffs["content.txt"]
+
+
+def test_hashcache(testdirectory):
+    testdirectory.write_text("a.txt", "a")
+    path = testdirectory.tmpdir / "cache" / "hashes.json"
+
+    hashes = HashCache(path=path)
+    digest = hashes.hash_file(testdirectory.tmpdir / "a.txt")
+    hashes.save()
+
+    # The digest is reused while the file is unchanged
+    hashes = HashCache(path=path)
+    entry = hashes.entries[str(testdirectory.tmpdir / "a.txt")]
+    entry[3] = "cached"
+    assert hashes.hash_file(testdirectory.tmpdir / "a.txt") == "cached"
+
+    testdirectory.write_text("a.txt", "ab")
+    assert hashes.hash_file(testdirectory.tmpdir / "a.txt") != digest
+
+    # Processes sharing the file keep each other's entries, and the entries
+    # of removed files are dropped
+    testdirectory.write_text("b.txt", "b")
+    other = HashCache(path=path)
+    other.hash_file(testdirectory.tmpdir / "b.txt")
+    other.save()
+    hashes.save()
+
+    entries = HashCache(path=path).entries
+    assert sorted(entries) == [
+        str(testdirectory.tmpdir / "a.txt"),
+        str(testdirectory.tmpdir / "b.txt"),
+    ]
+
+    testdirectory.rmfile("b.txt")
+    other.hash_file(testdirectory.tmpdir / "a.txt")
+    other.save()
+    assert list(HashCache(path=path).entries) == [str(testdirectory.tmpdir / "a.txt")]